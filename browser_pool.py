@@ -0,0 +1,144 @@
+import time
+import queue
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support.ui import WebDriverWait
+from tracing import span, traced
+
+
+class StepTimeout(TimeoutError):
+    """A page step did not become ready before its deadline."""
+    def __init__(self, step, timeout, url):
+        super().__init__(f"step '{step}' not ready after {timeout}s on {url}")
+        self.step = step
+        self.timeout = timeout
+        self.url = url
+
+
+# Per-step wait latencies in seconds, and the number of timeouts, across all drivers
+step_latency = defaultdict(list)
+step_timeouts = defaultdict(int)
+step_lock = threading.Lock()
+
+
+def wait_for(driver, step, condition, timeout, poll_frequency=0.05):
+    # Return as soon as `condition` holds instead of sleeping for the worst case
+    start = time.monotonic()
+    try:
+        with span(step):
+            return WebDriverWait(driver, timeout, poll_frequency=poll_frequency).until(condition)
+    except TimeoutException:
+        with step_lock:
+            step_timeouts[step] += 1
+        raise StepTimeout(step, timeout, driver.current_url) from None
+    finally:
+        with step_lock:
+            step_latency[step].append(time.monotonic() - start)
+
+
+def step_latency_report():
+    with step_lock:
+        lines = []
+        for step, latencies in step_latency.items():
+            ordered = sorted(latencies)
+            p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+            lines.append('{:<16} n={:<5} mean={:.3f}s p95={:.3f}s max={:.3f}s timeouts={}'.format(
+                step, len(ordered), sum(ordered) / len(ordered), p95, ordered[-1], step_timeouts[step]))
+        return '\n'.join(lines)
+
+
+class DriverPool:
+    """A bounded set of Chrome drivers, each lent to one visual search at a time.
+
+    Drivers are started on demand, health-checked before they are lent out, and replaced after
+    `recycle_after` lookups or as soon as the browser fails (a WebDriverException, which includes
+    page load timeouts). A lookup that fails otherwise, e.g. a page step missing its deadline, gives
+    the driver back. `on_create` is run on every new driver (e.g. to pass Google's human verification).
+    """
+    def __init__(self, size=1, headless=False, recycle_after=50, page_load_timeout=30, on_create=None):
+        self.size = size
+        self.headless = headless
+        self.recycle_after = recycle_after
+        self.page_load_timeout = page_load_timeout
+        self.on_create = on_create
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()
+        self.uses = {}
+        self.lock = threading.Lock()
+
+    @traced('start_driver')
+    def new_driver(self):
+        # Find the chromederver suitable for your chrome version here: https://googlechromelabs.github.io/chrome-for-testing/#stable, put it under the root directory of this project
+        options = webdriver.ChromeOptions()
+        options.add_argument("--lang=en")
+        if self.headless:
+            options.add_argument("--headless=new")
+            options.add_argument("--window-size=1280,1024")
+        driver = webdriver.Chrome(options=options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        if self.on_create is not None:
+            try:
+                self.on_create(driver)
+            except BaseException:
+                self.discard(driver)
+                raise
+        with self.lock:
+            self.uses[id(driver)] = 0
+        return driver
+
+    def healthy(self, driver):
+        try:
+            return driver.execute_script("return 1") == 1
+        except Exception:
+            return False
+
+    def discard(self, driver):
+        with self.lock:
+            self.uses.pop(id(driver), None)
+        try: driver.quit()
+        except Exception: pass
+
+    def checkout(self):
+        while True:
+            try:
+                driver = self.idle.get_nowait()
+            except queue.Empty:
+                return self.new_driver()
+            if self.healthy(driver):
+                return driver
+            self.discard(driver)
+
+    def checkin(self, driver):
+        with self.lock:
+            self.uses[id(driver)] += 1
+            worn_out = self.uses[id(driver)] >= self.recycle_after
+        if worn_out:
+            self.discard(driver)
+        else:
+            self.idle.put(driver)
+
+    @contextmanager
+    def driver(self):
+        with self.slots:
+            driver = self.checkout()
+            try:
+                yield driver
+            except WebDriverException:
+                # The browser or its session is broken; restarting it is cheaper than a string of failures
+                self.discard(driver)
+                raise
+            except BaseException:
+                # The next lookup starts from a fresh page load
+                self.checkin(driver)
+                raise
+            self.checkin(driver)
+
+    def close(self):
+        while True:
+            try:
+                self.discard(self.idle.get_nowait())
+            except queue.Empty:
+                return
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from functools import lru_cache
+from concurrent.futures import Future
+
+
+def cache_key(**parts):
+    # Stable hash over every input that can change the cached value
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')).hexdigest()
+
+
+@lru_cache(maxsize=4096)
+def _file_digest(path, mtime, size):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def image_digest(source):
+    # Content hash for local images, the URL itself for remote ones
+    if source and os.path.isfile(source):
+        stat = os.stat(source)
+        return 'sha256:' + _file_digest(os.path.abspath(source), stat.st_mtime, stat.st_size)
+    return 'url:' + (source or '')
+
+
+class CacheStore:
+    """Persistent key -> JSON value store in a single SQLite file.
+
+    Writes are single atomic transactions in WAL mode, so several threads and processes can read and
+    append at the same time and a crash never leaves a half-written cache behind. When `max_bytes` is
+    set, the least recently read entries are evicted once the stored values outgrow it.
+    """
+    def __init__(self, path, max_bytes=None, compress=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compress = compress
+        self.local = threading.local()
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        conn = self.connection()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+            CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta VALUES ('total_size', 0);
+            CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+                UPDATE meta SET value = value + new.size WHERE name = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+                UPDATE meta SET value = value + new.size - old.size WHERE name = 'total_size';
+            END;
+            CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+                UPDATE meta SET value = value - old.size WHERE name = 'total_size';
+            END;
+        ''')
+
+    def connection(self):
+        # sqlite3 connections must not be shared across threads, so keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def _encode(self, value):
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8')
+        return zlib.compress(data) if self.compress else data
+
+    def _decode(self, data):
+        if self.compress:
+            data = zlib.decompress(data)
+        return json.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+
+    def get(self, key, default=None):
+        conn = self.connection()
+        row = conn.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return default
+        conn.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+        return self._decode(row[0])
+
+    def put(self, key, value):
+        data = self._encode(value)
+        now = time.time()
+        conn = self.connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('''INSERT INTO entries (key, value, size, created, last_access) VALUES (?, ?, ?, ?, ?)
+                            ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size,
+                            created = excluded.created, last_access = excluded.last_access''',
+                         (key, sqlite3.Binary(data), len(data), now, now))
+            if self.max_bytes is not None:
+                self._evict(conn)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def _evict(self, conn, batch=16):
+        while conn.execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0] > self.max_bytes:
+            deleted = conn.execute('''DELETE FROM entries WHERE key IN
+                                      (SELECT key FROM entries ORDER BY last_access LIMIT ?)''', (batch,)).rowcount
+            if deleted == 0:
+                break
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def __contains__(self, key):
+        return self.connection().execute('SELECT 1 FROM entries WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def total_size(self):
+        return self.connection().execute("SELECT value FROM meta WHERE name = 'total_size'").fetchone()[0]
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; callers arriving meanwhile wait for and share its result."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+            call.set_result(result)
+            return result
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
@@ -0,0 +1,86 @@
+import json
+import argparse
+from configs import out_root, topic_filter_policy
+
+# Calibrate the keep/drop thresholds of the BM25 pre-ranker of topic_relevance_filter on recorded runs.
+# Only results labeled by the model are used, so record with topic_filter_policy["prerank"] = False
+# (every result goes to the model) to calibrate from scratch.
+parser = argparse.ArgumentParser()
+parser.add_argument('logs', nargs='*', default=[out_root + 'search_results.jsonl'], help='search_results.jsonl files of recorded runs')
+parser.add_argument('--max_error', type=float, default=0.05, help='Largest share of local decisions allowed to disagree with the model, on each side')
+parser.add_argument('--output', type=str, default=out_root + 'prerank_calibration.json', help='Where to write the report')
+args = parser.parse_args()
+
+
+def read_log(path):
+    # The log is a sequence of indented JSON objects, one per item
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            return
+        record, position = decoder.raw_decode(text, position)
+        yield record
+
+
+items = []
+for path in args.logs:
+    for record in read_log(path):
+        labeled = [(entry['score'], entry['label'] is True) for entry in record.get('relevance', []) if entry['by'] == 'model']
+        if labeled:
+            items.append(labeled)
+pairs = [pair for item in items for pair in item]
+if not pairs:
+    raise ValueError('No model-labeled search results in {}'.format(', '.join(args.logs)))
+
+
+def drop_threshold(pairs, max_error):
+    # Highest score at or below which at most max_error of the results are relevant
+    best = -1.0
+    for t in sorted(set(s for s, _ in pairs)):
+        below = [label for s, label in pairs if s <= t]
+        if sum(below) <= max_error * len(below):
+            best = t
+    return best
+
+
+def keep_threshold(pairs, max_error):
+    # Lowest score at or above which at most max_error of the results are irrelevant
+    best = 1.0
+    for t in sorted(set(s for s, _ in pairs), reverse=True):
+        above = [label for s, label in pairs if s >= t]
+        if len(above) - sum(above) <= max_error * len(above):
+            best = t
+    return best
+
+
+drop = drop_threshold(pairs, args.max_error)
+keep = keep_threshold(pairs, args.max_error)
+if keep <= drop:
+    keep = min([s for s, _ in pairs if s > drop], default=1.0)
+
+decided = [(s, label) for s, label in pairs if s >= keep or s <= drop]
+wrong = sum(1 for s, label in decided if (s >= keep) != label)
+skipped = sum(1 for item in items if all(s >= keep or s <= drop for s, _ in item))
+report = {
+    'items': len(items),
+    'results': len(pairs),
+    'relevant_share': sum(label for _, label in pairs) / len(pairs),
+    'keep': keep,
+    'drop': drop,
+    'decided_locally': len(decided) / len(pairs),
+    'local_error': wrong / len(decided) if decided else 0.0,
+    'items_without_model_call': skipped / len(items),
+    'current': {'keep': topic_filter_policy['keep'], 'drop': topic_filter_policy['drop']},
+}
+print('{} model-labeled results of {} items, {:.1%} relevant'.format(len(pairs), len(items), report['relevant_share']))
+print('keep >= {:.4f}, drop <= {:.4f}: {:.1%} of the results decided locally with {:.1%} disagreement, '
+      '{:.1%} of the items need no model call'.format(keep, drop, report['decided_locally'], report['local_error'],
+                                                       report['items_without_model_call']))
+print('Set in configs.py: topic_filter_policy["keep"] = {:.4f}, topic_filter_policy["drop"] = {:.4f}'.format(keep, drop))
+with open(args.output, 'w', encoding='utf-8') as f:
+    json.dump(report, f, indent=4)
@@ -0,0 +1,88 @@
+import time
+from cache_store import CacheStore, cache_key
+
+
+class CassetteMiss(LookupError):
+    """Replay asked for a call that was never recorded."""
+    def __init__(self, kind, parts):
+        super().__init__(f"no recorded {kind} call for {str(parts)[:200]}")
+        self.kind = kind
+
+
+class ReplayedError(RuntimeError):
+    """A call that raised while it was recorded raises this when replayed."""
+
+
+class Cassette:
+    """Record/replay of the external calls of a run (OpenAI, DuckDuckGo, newspaper, visual search).
+
+    In record mode every call goes out as usual and its result (or error) and latency are stored in a
+    compressed CacheStore, keyed by the call's inputs. In replay mode the stored results are served
+    without touching the network, after sleeping `latency_scale` times the recorded latency, so a
+    recorded run can be repeated offline to measure the framework itself. `kinds` limits the cassette
+    to some of the call kinds; the others go out as usual. Off by default.
+    """
+    kinds_all = ('openai', 'ddgs', 'newspaper', 'visual_search')
+
+    def __init__(self):
+        self.mode = None
+        self.store = None
+        self.latency_scale = 0.0
+        self.kinds = set()
+
+    def configure(self, path, mode, latency_scale=0.0, kinds=kinds_all):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}')
+        self.mode = mode
+        self.store = CacheStore(path, compress=True)
+        self.latency_scale = latency_scale
+        self.kinds = set(kinds)
+
+    def active(self, kind):
+        return self.mode is not None and kind in self.kinds
+
+    def replays(self, kind):
+        return self.mode == 'replay' and kind in self.kinds
+
+    def replay(self, kind, parts):
+        # -> (entry, seconds to wait before answering)
+        entry = self.store.get(cache_key(kind=kind, **parts))
+        if entry is None:
+            raise CassetteMiss(kind, parts)
+        return entry, entry['latency'] * self.latency_scale
+
+    def answer(self, entry):
+        if 'error' in entry:
+            raise ReplayedError(entry['error'])
+        return entry['value']
+
+    def record(self, kind, parts, start, value=None, error=None):
+        key = cache_key(kind=kind, **parts)
+        latency = time.monotonic() - start
+        if error is None:
+            self.store.put(key, {'value': value, 'latency': latency})
+        elif key not in self.store:
+            # A call that once succeeded keeps its answer, even if a later identical call failed
+            self.store.put(key, {'error': f'{type(error).__name__}: {error}', 'latency': latency})
+
+    def call(self, kind, parts, fn):
+        # fn() -> JSON-serializable result of the real call; `parts` identify the call
+        if not self.active(kind):
+            return fn()
+        if self.mode == 'replay':
+            entry, delay = self.replay(kind, parts)
+            if delay > 0:
+                time.sleep(delay)
+            return self.answer(entry)
+        start = time.monotonic()
+        try:
+            value = fn()
+        except Exception as e:
+            self.record(kind, parts, start, error=e)
+            raise
+        self.record(kind, parts, start, value)
+        return value
+
+
+# Shared by the whole process; configured by lemma.py --record / --replay
+cassette = Cassette()
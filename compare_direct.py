@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from pipeline import LemmaPipeline, direct_prediction, fused_decision
+from configs import out_root
+from utils import metric, pwarn
+
+# Side-by-side accuracy and latency of the two-call Direct + external_knowledge path and the fused Direct path
+parser = argparse.ArgumentParser()
+parser.add_argument('datasets', nargs='*', default=['data/twitter/twitter.json', 'data/fakeddit/FAKEDDIT.json'],
+                    help='Dataset files to compare on')
+parser.add_argument('--limit', type=int, default=None, help='Only use the first N items of each dataset')
+parser.add_argument('--workers', type=int, default=1, help='Number of items processed concurrently')
+parser.add_argument('--use_cache', action='store_true', default=False, help='Reuse cached answers (latencies are then meaningless)')
+parser.add_argument('--use_offline_image', action='store_true', default=False, help='Use offline image instead of online image')
+parser.add_argument('--output', type=str, default=out_root + 'direct_comparison.json', help='Where to write the report')
+args = parser.parse_args()
+
+if args.use_cache:
+    pwarn('--use_cache is set, cached answers make the latencies of both paths meaningless')
+
+pipeline = LemmaPipeline(use_cache=args.use_cache, online_image=not args.use_offline_image)
+
+
+def two_call(item):
+    start = time.monotonic()
+    direct = pipeline.direct_module(**pipeline.direct_inputs(item))
+    decision = None
+    if direct is not None:
+        decision = pipeline.external_knowledge_module(**pipeline.external_inputs(item, direct))
+    return direct, decision, time.monotonic() - start
+
+
+def fused(item):
+    start = time.monotonic()
+    direct = pipeline.fused_direct_module(**pipeline.direct_inputs(item))
+    decision = fused_decision(direct) if direct is not None else None
+    return direct, decision, time.monotonic() - start
+
+
+def outcome(item, result):
+    direct, decision, latency = result
+    if direct is None or decision is None:
+        return None
+    return {'prediction': direct_prediction(direct), 'external': 0 if "no" in decision['external knowledge'].lower() else 1,
+            'latency': latency}
+
+
+def summary(labels, outcomes):
+    done = [(label, o) for label, o in zip(labels, outcomes) if o is not None]
+    latencies = sorted(o['latency'] for _, o in done)
+    result = {'items': len(outcomes), 'failed': len(outcomes) - len(done)}
+    if done:
+        scores = metric([label for label, _ in done], [o['prediction'] for _, o in done])
+        result.update({
+            'accuracy': scores['accuracy'],
+            'rumor_f1': scores['rumor']['f1'],
+            'non_rumor_f1': scores['non_rumor']['f1'],
+            'external_rate': sum(o['external'] for _, o in done) / len(done),
+            'latency_mean': sum(latencies) / len(latencies),
+            'latency_p50': latencies[len(latencies) // 2],
+            'latency_p95': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+        })
+    return result
+
+
+def compare(dataset):
+    with open(dataset, encoding='utf-8') as f:
+        data = json.load(f)[:args.limit]
+    labels = [item['label'] for item in data]
+    paths = {'two_call': two_call, 'fused': fused}
+    outcomes = {}
+    for name, fn in paths.items():
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            outcomes[name] = [outcome(item, result) for item, result in zip(data, executor.map(fn, data))]
+        print('{} {}: {} items in {:.1f}s'.format(dataset, name, len(data), time.monotonic() - start))
+
+    both = [(a, b) for a, b in zip(outcomes['two_call'], outcomes['fused']) if a is not None and b is not None]
+    report = {name: summary(labels, outcomes[name]) for name in paths}
+    report['agreement'] = {
+        'items': len(both),
+        'label': sum(a['prediction'] == b['prediction'] for a, b in both) / len(both) if both else None,
+        'external': sum(a['external'] == b['external'] for a, b in both) / len(both) if both else None,
+    }
+    return report
+
+
+def format_report(dataset, report):
+    lines = [dataset]
+    lines.append('{:<10} {:>6} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}'.format(
+        'path', 'items', 'failed', 'accuracy', 'rumor_f1', 'external', 'mean_s', 'p50_s', 'p95_s'))
+    for name in ('two_call', 'fused'):
+        r = report[name]
+        if 'accuracy' not in r:
+            lines.append('{:<10} {:>6} {:>7}'.format(name, r['items'], r['failed']))
+            continue
+        lines.append('{:<10} {:>6} {:>7} {:>9.4f} {:>9.4f} {:>9.4f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            name, r['items'], r['failed'], r['accuracy'], r['rumor_f1'], r['external_rate'],
+            r['latency_mean'], r['latency_p50'], r['latency_p95']))
+    agreement = report['agreement']
+    if agreement['items']:
+        lines.append('Agreement over {} items: label {:.4f}, external knowledge {:.4f}'.format(
+            agreement['items'], agreement['label'], agreement['external']))
+    return '\n'.join(lines)
+
+
+reports = {}
+for dataset in args.datasets:
+    reports[dataset] = compare(dataset)
+    print(format_report(dataset, reports[dataset]))
+
+output_dir = os.path.dirname(args.output)
+if output_dir and not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+with open(args.output, 'w', encoding='utf-8') as f:
+    json.dump(reports, f, indent=4)
+print('Report written to', args.output)
@@ -7,4 +7,125 @@ if not os.path.exists(cache_root):
     os.makedirs(cache_root)
 imgbed_root="https://raw.githubusercontent.com/fan19-hub/LEMMA/main/"
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
-definition_path = "prompts/definition.json"
\ No newline at end of file
+definition_path = "prompts/definition.json"
+# Maximum number of concurrent calls per external backend when running with --workers
+backend_concurrency = {
+    "openai": 8,      # chat completions
+    "search": 2,      # DuckDuckGo text search (one session each)
+    "scraper": 8,     # newspaper3k article downloads
+}
+
+# Chrome drivers used by visual_search (size and headless can be overridden from lemma.py)
+browser_pool = {
+    "size": 1,
+    "headless": False,
+    "recycle_after": 50,        # lookups served by one driver before it is replaced
+    "page_load_timeout": 30,    # seconds before a stuck page fails the lookup
+}
+
+# Starting requests/min and tokens/min per model; corrected from the x-ratelimit-* response headers
+openai_rate_limits = {
+    "default": {"rpm": 500, "tpm": 30000},
+    "gpt-4o": {"rpm": 500, "tpm": 30000},
+    "gpt-4-turbo": {"rpm": 500, "tpm": 30000},
+    "gpt-4-vision-preview": {"rpm": 100, "tpm": 10000},
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 60000},
+}
+
+# Keep-alive HTTP connection pool of the shared OpenAI transport
+openai_pool = {
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 60,
+    "timeout": 120,
+    "connect_timeout": 10,
+}
+
+# Size limit of each LemmaComponent cache file; least recently used entries are evicted beyond it
+component_cache_max_bytes = 512 * 1024 * 1024
+
+# Seconds each visual_search page step may take before the lookup fails. "exact_matches" is
+# counted from the loaded Lens page: many images have no exact matches, which is not a failure
+visual_search_deadlines = {
+    "lens_button": 10,
+    "upload_box": 5,
+    "search_button": 5,
+    "lens_results": 15,
+    "exact_matches": 3,
+    "results": 15,
+}
+
+# Article scraping in evidence_extraction
+scraper_policy = {
+    "connect_timeout": 5,     # seconds
+    "read_timeout": 15,       # seconds
+    "per_domain": 2,          # concurrent downloads from one domain
+    "attempts": 2,
+    "backoff": 2,             # seconds before retrying a failed domain, doubled per failure
+    "max_backoff": 60,
+    "batch_deadline": 30,     # seconds for all pages of one evidence_extraction call
+}
+
+# Seconds a cached article stays valid (used with --use_cache); failed fetches are retried sooner
+article_cache_ttl = {
+    "ok": 30 * 24 * 3600,
+    "failed": 24 * 3600,
+}
+
+# DuckDuckGo text search
+search_policy = {
+    "interval": 1.0,                # minimum seconds between two search requests
+    "cache_ttl": 7 * 24 * 3600,     # seconds a cached result list stays valid (used with --use_cache)
+}
+
+# Per-stage call metrics (telemetry.py), exported as an OpenMetrics text file during a run
+telemetry_policy = {
+    "export_interval": 10,     # seconds between two rewrites of the metrics file
+    "latency_buckets": [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120],     # seconds
+}
+
+# Models that accept response_format={"type": "json_object"} (JSON mode)
+json_mode_models = {"gpt-4o", "gpt-4-turbo", "gpt-3.5-turbo"}
+
+# Delay before a LemmaComponent re-queries: base * 2^attempt seconds with jitter, at most max,
+# and never less than the Retry-After of the error
+retry_policy = {
+    "base": 1.0,
+    "max": 30.0,
+}
+
+# Token budgets of the evidence handed to the refine prompt (evidence_packer.py)
+evidence_budget = {
+    "text": 800,        # web evidence from get_evidence
+    "visual": 150,      # pages the image occurs in, from visual_search
+}
+
+# Local BM25 pre-ranking in topic_relevance_filter: search results scoring at least `keep` are kept and
+# those at most `drop` are dropped without a model call; only the ones in between go to gpt-4-turbo.
+# Scores are in [0, 1); calibrate with calibrate_prerank.py. prerank=False sends every result to the model.
+topic_filter_policy = {
+    "prerank": True,
+    "keep": 0.20,
+    "drop": 0.02,
+}
+
+# Near-duplicate search results collapsed in get_evidence (near_duplicates.py): MinHash similarity of the
+# title and body word bigrams at or above `threshold`, found through `bands` LSH bands of num_perm hashes
+near_duplicate_policy = {
+    "threshold": 0.6,
+    "num_perm": 64,
+    "bands": 16,
+}
+
+# Search and visual search results from these domains (and their subdomains) are dropped
+untrusted_sources = {"reddit.com", "weibo.com", "twitter.com", "tiktok.com", "douyin.com", "instagram.com", "taobao.com",
+                     "jd.com", "amazon.com", "ebay.com", "imdb.com", "douban.com", "steamcommunity.com", "m.ixigua.com",
+                     "bilibili.com", "netflix.com"}
+# Extra blocklist files: one domain per line, hosts-file lines or Adblock ||domain^ rules
+source_blocklists = []
+
+# Language detection of search queries (region_detection.py): langdetect seed and number of memoized texts
+region_detection = {
+    "seed": 0,
+    "memo_size": 4096,
+}
@@ -0,0 +1,152 @@
+import re
+import math
+import threading
+from collections import Counter
+
+# Packs retrieved evidence into the token budget of the refine prompt: snippets are scored by
+# relevance to the post, sentences repeated across snippets are dropped, and the most relevant
+# snippets are kept until the budget is full, the last one cut to fit.
+
+word_pattern = re.compile(r"\w+")
+stopwords = set("""a an and are as at be been but by can could did do does for from had has have he her his how i if in
+into is it its just may me more most my no not of on or our out over she so some such than that the their them then there
+these they this those to up us was we were what when where which while who why will with would you your""".split())
+# Rough BPE pieces, used to count tokens when tiktoken is not installed
+piece_pattern = re.compile(r"\w{1,5}|[^\w\s]")
+sentence_pattern = re.compile(r"(?<=[.!?。！？])\s+|\n+")
+
+encoding = None
+encoding_lock = threading.Lock()
+encoding_loaded = False
+
+
+def get_encoding():
+    # tiktoken is optional; without it token counts are estimated from the text pieces
+    global encoding, encoding_loaded
+    with encoding_lock:
+        if not encoding_loaded:
+            encoding_loaded = True
+            try:
+                import tiktoken
+                encoding = tiktoken.get_encoding("o200k_base")
+            except Exception:
+                encoding = None
+        return encoding
+
+
+def count_tokens(text):
+    enc = get_encoding()
+    if enc is not None:
+        return len(enc.encode(text))
+    return len(piece_pattern.findall(text))
+
+
+def truncate_tokens(text, n):
+    # First n tokens of text (by count_tokens)
+    if n <= 0:
+        return ""
+    enc = get_encoding()
+    if enc is not None:
+        tokens = enc.encode(text)
+        return text if len(tokens) <= n else enc.decode(tokens[:n])
+    pieces = list(piece_pattern.finditer(text))
+    return text if len(pieces) <= n else text[:pieces[n - 1].end()]
+
+
+def terms(text):
+    return [w for w in word_pattern.findall(text.lower()) if len(w) > 1 and w not in stopwords]
+
+
+def tfidf_vectors(texts):
+    # One {term: tf-idf weight} vector per text, with idf over the given texts
+    counts = [Counter(terms(t)) for t in texts]
+    df = Counter(term for c in counts for term in c)
+    n = len(texts)
+    return [{term: (1 + math.log(tf)) * math.log(1 + n / df[term]) for term, tf in c.items()} for c in counts]
+
+
+def cosine(a, b):
+    dot = sum(w * b[t] for t, w in a.items() if t in b)
+    if dot == 0:
+        return 0.0
+    return dot / (math.sqrt(sum(w * w for w in a.values())) * math.sqrt(sum(w * w for w in b.values())))
+
+
+def relevance(query, texts):
+    # Cosine similarity of each text to the query, in [0, 1]
+    vectors = tfidf_vectors([query] + list(texts))
+    return [cosine(vectors[0], v) for v in vectors[1:]]
+
+
+class Deduper:
+    """Drops sentences whose word trigrams were mostly seen in earlier kept sentences.
+
+    Sentences of fewer than `min_words` words (titles, fragments) are always kept.
+    """
+    def __init__(self, threshold=0.8, min_words=4):
+        self.threshold = threshold
+        self.min_words = min_words
+        self.seen = set()
+        self.dropped = 0
+
+    def filter(self, text):
+        kept = []
+        for sentence in sentence_pattern.split(text):
+            sentence = sentence.strip()
+            words = terms(sentence)
+            if len(words) < self.min_words:
+                if sentence:
+                    kept.append(sentence)
+                continue
+            shingles = {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+            if len(shingles & self.seen) >= self.threshold * len(shingles):
+                self.dropped += 1
+                continue
+            self.seen |= shingles
+            kept.append(sentence)
+        return " ".join(kept)
+
+
+def pack(query, groups, budget, header="Information related to '{}':", dedupe_threshold=0.8):
+    """Pack evidence into at most `budget` tokens -> (text, report).
+
+    `groups` is a list of (group name, [snippet text]), e.g. one group per search query. Snippets
+    are kept in order of relevance to `query` until the budget is used up; the first one that does
+    not fit is cut to the remaining tokens. The output lists the kept snippets under their group's
+    header, in the original group order, as plain text.
+    """
+    snippets = [(g, s) for g, (_, texts) in enumerate(groups) for s in texts if s and s.strip()]
+    scores = relevance(query, [s for _, s in snippets])
+    order = sorted(range(len(snippets)), key=lambda i: -scores[i])
+
+    deduper = Deduper(dedupe_threshold)
+    chosen = {}
+    used = 0
+    headers_used = set()
+    for i in order:
+        g, text = snippets[i]
+        text = deduper.filter(text)
+        if not text:
+            continue
+        head = 0 if g in headers_used else count_tokens(header.format(groups[g][0]) + "\n\n")
+        line = count_tokens("- " + text + "\n")
+        if used + head + line > budget:
+            text = truncate_tokens(text, budget - used - head - (line - count_tokens(text)))
+            if text:
+                chosen[i] = text
+            break
+        chosen[i] = text
+        headers_used.add(g)
+        used += head + line
+
+    blocks = []
+    for g, (name, _) in enumerate(groups):
+        lines = ["- " + chosen[i] for i in range(len(snippets)) if i in chosen and snippets[i][0] == g]
+        if lines:
+            blocks.append(header.format(name) + "\n" + "\n".join(lines))
+    packed = "\n\n".join(blocks)
+    # Token counts are not exactly additive across joins; the budget is a hard limit
+    if count_tokens(packed) > budget:
+        packed = truncate_tokens(packed, budget)
+    return packed, {"budget": budget, "snippets": len(snippets), "kept": len(chosen),
+                    "duplicate_sentences": deduper.dropped, "tokens": count_tokens(packed)}
@@ -1,21 +1,55 @@
-import re
 import os
 import json
 import argparse
-from lemma_component import LemmaComponent
-from retrieval import get_evidence, visual_search, driver_quit
-from configs import out_root, definition_path
-from utils import save, process_multilines_output, perror
-import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pipeline import LemmaPipeline
+from stage_runner import StageRunner
+from retrieval import driver_quit, configure_retrieval, source_index
+from browser_pool import step_latency_report
+from telemetry import telemetry
+from tracing import tracer, span
+from cassette import cassette
+from result_log import ResultLog
+from configs import out_root
+from utils import MetricsAccumulator, save_records
 
 # Arg parser
 parser = argparse.ArgumentParser()
 parser.add_argument('--input_file_name', type=str, default='exampleinput.json', help='Input file name')
-parser.add_argument('--use_cache', action='store_true', default=False, help='Use cache for modules except final prediction')
+parser.add_argument('--use_cache', action='store_true', default=False, help='Use cache for all modules and retrieval')
 parser.add_argument('--resume', action='store_true', default=False, help='Resume from the last time')
 parser.add_argument('--use_offline_image', action='store_true', default=False, help='Use offline image flag')
+parser.add_argument('--workers', type=int, default=1, help='Number of items processed concurrently')
+parser.add_argument('--browser_pool_size', type=int, default=None, help='Number of Chrome drivers for visual search')
+parser.add_argument('--headless', action='store_true', default=None, help='Run the Chrome drivers headless')
+parser.add_argument('--save_every', type=int, default=20, help='Rewrite lemma_output.json and lemma_score every N finished items')
+parser.add_argument('--shard', type=str, default=None, help='Only run shard i of N (every N-th item starting at i), given as i/N')
+parser.add_argument('--schedule', type=str, default='item', choices=['item', 'stage'], help='Run items one after another through all components, or each component over all items')
+parser.add_argument('--batch_api', action='store_true', default=False, help='With --schedule stage, send each model stage as one OpenAI batch job')
+parser.add_argument('--batch_poll_interval', type=int, default=30, help='Seconds between batch job status checks')
+parser.add_argument('--metrics_file', type=str, default=None, help='OpenMetrics file of per-stage call metrics (default: <output dir>/lemma_metrics.prom)')
+parser.add_argument('--trace', type=str, default=None, help='Write a Chrome trace-event JSON of the run to this file (open it in Perfetto)')
+parser.add_argument('--record', type=str, default=None, help='Record every OpenAI, DuckDuckGo, newspaper and visual search call into this cassette file')
+parser.add_argument('--replay', type=str, default=None, help='Serve every external call from this cassette file instead of the network')
+parser.add_argument('--replay_latency', type=float, default=0.0, help='With --replay, wait this multiple of each recorded latency before answering')
+parser.add_argument('--blocklist', type=str, action='append', default=[], help='Also drop search results from the domains in this file (repeatable)')
+parser.add_argument('--fused_direct', action='store_true', default=False, help='Get the Direct prediction and the external knowledge decision from one model call')
 args = parser.parse_args()
 
+if args.record is not None and args.replay is not None:
+    raise ValueError('--record and --replay cannot be used together')
+if args.record is not None and args.use_cache:
+    raise ValueError('--record cannot be used with --use_cache, cache hits would be missing from the cassette')
+if args.replay is not None and args.batch_api:
+    raise ValueError('--batch_api cannot be replayed from a cassette')
+
+# Shard
+shard_index, num_shards = 0, 1
+if args.shard is not None:
+    shard_index, num_shards = (int(x) for x in args.shard.split('/'))
+    if not 0 <= shard_index < num_shards:
+        raise ValueError('Invalid shard {}, expected i/N with 0 <= i < N'.format(args.shard))
+
 # Input file
 input_file = args.input_file_name
 
@@ -23,179 +57,113 @@ with open(input_file, encoding='utf-8') as file:
     data = json.load(file)
 
 # Output file
-output_score = out_root + "lemma_"+"score"
-output_result = out_root + "lemma_"+"output.json"
-if not os.path.exists(out_root):
-    os.makedirs(out_root)   
+# Each shard writes to its own directory; merge.py combines them
+output_dir = out_root if num_shards == 1 else out_root + "shard_{}_of_{}/".format(shard_index, num_shards)
+output_score = output_dir + "lemma_"+"score"
+output_result = output_dir + "lemma_"+"output.json"
+output_log = output_dir + "lemma_"+"output.jsonl"
+output_checkpoint = output_dir + "lemma_"+"checkpoint.json"
+if not os.path.exists(output_dir):
+    os.makedirs(output_dir)   
     
 # Resume
-labels = []
-direct_labels = []
-final_preds = []
+# lemma_output.jsonl is the source of truth; lemma_output.json and lemma_score are rebuilt from it
 total_data_size = len(data)
-current_index = -1
-logger = []
-if args.resume and os.path.exists(output_score):
-    with open(output_score, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-        labels = []
-        for char in lines[1]:
-            if char.isdigit():
-                labels.append(int(char))
-        direct_labels = []
-        for char in lines[3]:
-            if char.isdigit():
-                direct_labels.append(int(char))
-        final_preds = []
-        for char in lines[5]:
-            if char.isdigit():
-                final_preds.append(int(char))
-        current_index = int(lines[6].split(':')[1].strip())
-    with open(output_result, 'r', encoding='utf-8') as f:
-        logger = json.load(f)
-    total_data_size = len(data)
-    data = data[current_index + 1:]
-if current_index==-1:
+records = ResultLog.read(output_log) if args.resume else {}
+todo = [(index, item) for index, item in enumerate(data) if index % num_shards == shard_index and index not in records]
+metrics = MetricsAccumulator()
+if args.resume and os.path.exists(output_checkpoint):
+    with open(output_checkpoint, 'r', encoding='utf-8') as f:
+        metrics = MetricsAccumulator.from_dict(json.load(f)['metrics'])
+    # A checkpoint of an older run that the log no longer matches is rebuilt from the log
+    if any(index not in records for index in metrics.items):
+        metrics = MetricsAccumulator()
+# Items logged after the last checkpoint
+for index, record in records.items():
+    if record is not None and index not in metrics:
+        metrics.update(record['label'], record['direct'], record['prediction'], index=index)
+if not records:
     print('Starting from index 0')
 else:
-    print('Resuming from index:', current_index, ', Next index:', current_index + 1)
+    print('Resuming with {} items done, next index: {}'.format(len(records), todo[0][0] if todo else total_data_size))
+result_log = ResultLog(output_log, resume=args.resume)
 
-def parse_json_markdown(json_string: str) -> dict:
-    # Try to find JSON string within first and last triple backticks
-    match = re.search(r"""```       # match first occuring triple backticks
-                          (?:json)? # zero or one match of string json in non-capturing group
-                          (.*)```   # greedy match to last triple backticks""", json_string, flags=re.DOTALL|re.VERBOSE)
 
-    # If no match found, assume the entire string is a JSON string
-    if match is None:
-        json_str = json_string
-    else:
-        # If match found, use the content within the backticks
-        json_str = match.group(1)
+def materialize():
+    # Aggregate files in dataset order
+    if len(metrics) == 0: return
+    current_index = save_records(records, metrics, output_result, output_score)
+    with open(output_checkpoint + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump({'current_index': current_index, 'metrics': metrics.to_dict()}, f)
+    os.replace(output_checkpoint + '.tmp', output_checkpoint)
+
 
-    # Strip whitespace and newlines from the start and end
-    json_str = json_str.strip()
+def finish(index, record):
+    result_log.append(index, record)
+    records[index] = record
+    if record is not None:
+        metrics.update(record['label'], record['direct'], record['prediction'], index=index)
+        print('Accuracy so far: {:.4f} (direct {:.4f}) over {} items'.format(
+            metrics.counts['total_correct'] / len(metrics), metrics.counts['zero_shot_correct'] / len(metrics), len(metrics)))
+    if len(records) % args.save_every == 0:
+        materialize()
 
-    return json_str 
 
+# Call metrics, rewritten while the run is in progress
+telemetry.start_export(args.metrics_file or output_dir + "lemma_metrics.prom")
+
+# Span tracing, off unless --trace is given
+if args.trace is not None:
+    tracer.start(args.trace)
+
+# Record/replay of external calls
+if args.record is not None:
+    cassette.configure(args.record, 'record')
+elif args.replay is not None:
+    cassette.configure(args.replay, 'replay', latency_scale=args.replay_latency)
 
 # LEMMA Components Initialization
-direct_module = LemmaComponent(prompt='lemma_direct.md', name='Direct', model='gpt4v', using_cache=args.use_cache,
-                                  online_image=not args.use_offline_image, max_retry=3, max_tokens=1000, temperature=0.1,
-                                  post_process=lambda x: json.loads(x))
-external_knowledge_module = LemmaComponent(prompt='external_knowledge.md', name='external_knowledge',       
-                                  model='gpt4v', using_cache=args.use_cache,
-                                  online_image=not args.use_offline_image, max_retry=3, max_tokens=1000, temperature=0.1,
-                                  post_process=lambda x: json.loads(parse_json_markdown(x)))
-question_gen_module = LemmaComponent(prompt='question_gen.md', name='question_gen', model='gpt4v', using_cache=args.use_cache,
-                                     online_image=not args.use_offline_image, max_retry=3, max_tokens=1000, temperature=0.1,
-                                     post_process=lambda x: json.loads(x))
-refine_prediction_module = LemmaComponent(prompt='refined_prediction.md', name='modify_reasoning', model='gpt4v',
-                                         using_cache=False,
-                                         online_image=not args.use_offline_image, max_retry=3, max_tokens=1000, temperature=0.1,
-                                         post_process=process_multilines_output)
-# Test
-for i, item in enumerate(data):
-    current_index += 1
-    print('Processing index {}/{}'.format(current_index, total_data_size))
-
-    # Get input data
-    url = item["image_url"]
-    text = item["original_post"]
-    label = item["label"]
-
-    # Direct Prediction
-    direct = direct_module(TEXT=text, image=url)
-    print(direct)
-    
-    if direct is None: continue
-    direct_pred = 0 if "real" in direct['label'].lower() else 1
-    direct_explain = direct['explanation']
-
-    # External Knowledge
-    # Decide whether external knowledge is needed to further examine the input sample
-    decision_external = external_knowledge_module(REASONING = direct_explain, TEXT = text, image=url)
-    direct_external = 0 if "no" in decision_external['external knowledge'].lower() else 1 
-    print("######################")
-    print("Need External Knowledge:", direct_external)
-    print(decision_external['explanation'])
-    print("######################")
-
-    retrieved_text = None
-    if direct_external == 1:
-        # Query Generation
-        question_gen = question_gen_module(TEXT=text, 
-                                            PREDICTION=direct_pred, 
-                                            REASONING=direct_explain,
-                                            image=url)
-        
-        if question_gen is None: continue
-        title, questions = question_gen['title'], question_gen['questions']
-
-        # Evidence Retrieval
-        print("Lemma Component Evidence Retrieval: Starting...")
-        try:
-            retrieved_text = get_evidence(text, title, questions)
-        except Exception as e:
-            perror(traceback.format_exc())
-            retrieved_text = ""
+configure_retrieval(use_cache=args.use_cache, browser_pool_size=args.browser_pool_size, headless=args.headless,
+                    output_dir=output_dir, blocklists=args.blocklist)
+pipeline = LemmaPipeline(use_cache=args.use_cache, online_image=not args.use_offline_image, fused_direct=args.fused_direct)
+
+def run_item(index, item):
+    with span('item', index=index):
+        return pipeline(item)
 
-        try:
-            visual_retrieved_text = visual_search(url, text)
-        except Exception as e:
-            perror(traceback.format_exc())
-            visual_retrieved_text = ""
-
-        # Refined Prediction
-        rumor_types=["true", "satire/parody", "misleading content", "text image contradiction", "manipulated content", "unverified"]
-        refine_result = refine_prediction_module(TEXT=text,
-                                               ORIGINAL_REASONING=direct_explain,
-                                               EXTERNAL=retrieved_text,
-                                               EXTERNAL_VISUAL=visual_retrieved_text,
-                                               DEFINITION=open(definition_path, 'r').read(),
-                                               image=url)
-        
-        # Result Postprocessing
-        if refine_result is None: continue
-        refined_pred = refine_result["label"]
-        refined_explain =  refine_result
-
-        for rumor_type in rumor_types:
-            if rumor_type.lower() in refined_pred.lower():
-                refined_pred = rumor_type
-                break  
-        if refined_pred == 'true':
-            final_pred = 0
-        elif refined_pred == 'unverified':
-            final_pred = direct_pred   # If model is not sure, go back to direct prediction
-        else:
-            final_pred = 1
-        print('Refined Prediction:', refined_pred)
-        final_explain = refined_explain
-        retrieved_text = retrieved_text + visual_retrieved_text
 
+# Test
+try:
+    if args.schedule == 'stage':
+        # Stage outputs are kept in <output_dir>/stages/ and resumed per stage
+        runner = StageRunner(pipeline, output_dir + "stages/", workers=args.workers, batch_api=args.batch_api,
+                             poll_interval=args.batch_poll_interval, resume=args.resume)
+        stage_records = runner.run(data, [index for index, item in todo])
+        for index, item in todo:
+            finish(index, stage_records.get(index))
+    elif args.workers <= 1:
+        for index, item in todo:
+            print('Processing index {}/{}'.format(index, total_data_size))
+            finish(index, run_item(index, item))
     else:
-        final_pred = direct_pred
-        final_explain = direct_explain
-
-    # Logging
-    labels.append(label)
-    direct_labels.append(direct_pred)
-    final_preds.append(final_pred)
-    logger.append({
-        'text': text,
-        'image_url': url,
-        'tool_learning_text': retrieved_text,
-        'label': label,
-        'prediction': final_pred,
-        'explain': final_explain,
-        'direct': direct_pred,
-        'direct_explain': direct_explain,
-    })
-
-    print('\nLabel:', label, ', Refined Prediction:', final_pred, ', Direct:', direct_pred)
-    print('Refined Explain:', final_explain)
-
-    save(labels, final_preds, direct_labels, current_index, logger, output_result, output_score)
-    
-driver_quit()
\ No newline at end of file
+        # Items finish out of order; each is logged as soon as it is done
+        executor = ThreadPoolExecutor(max_workers=args.workers)
+        futures = {executor.submit(run_item, index, item): index for index, item in todo}
+        print('Processing {} items with {} workers'.format(len(todo), args.workers))
+        try:
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+finally:
+    result_log.close()
+    materialize()
+    telemetry.stop()
+    tracer.stop()
+
+driver_quit()
+print('Calls per stage:\n' + telemetry.summary())
+if source_index.summary():
+    print('Blocked sources: ' + source_index.summary())
+if step_latency_report():
+    print('Visual search step latency:\n' + step_latency_report())
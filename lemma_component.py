@@ -1,10 +1,23 @@
-import json
-from configs import prompts_root, imgbed_root, cache_root
-from utils import onlineImg_process, offlineImg_process, gpt_no_image
+from configs import imgbed_root, cache_root, component_cache_max_bytes
+from cache_store import CacheStore, cache_key, image_digest
+from time import sleep
+from llm_transport import get_transport, text_messages, image_messages, retry_delay
+from structured_output import repair_json, validate, json_mode
+from telemetry import telemetry
+from tracing import span
+from utils import encode_image, load_prompt
 
 class LemmaComponent:
+    """One prompted model call of the pipeline.
+
+    With a `schema` ({key: type}), the answer must be a JSON object with those keys: it is requested
+    in JSON mode where the model supports it, repaired locally if it does not parse, and only
+    re-queried if repair fails. Re-queries back off exponentially with jitter and honor Retry-After.
+    A prompt file split by a `<!-- item -->` line sends its first part, formatted once with
+    `static_fields`, as a system message shared by every item.
+    """
     def __init__(self, prompt, name, model='gpt4-o', using_cache=False, cache_name='', online_image=True, max_retry=5,
-                 max_tokens=1000, temperature=0.1, post_process=None):
+                 max_tokens=1000, temperature=0.1, post_process=None, schema=None, static_fields=None):
         self.name = name
         self.model = model
         self.using_cache = using_cache
@@ -13,69 +26,97 @@ class LemmaComponent:
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.post_process = post_process
+        self.schema = schema
 
         if cache_name != '':
             self.cache_name = cache_name
         else:
-            self.cache_name = self.name + '.json'
+            self.cache_name = self.name + '.sqlite'
 
         if type(prompt) == str:
-            with open(prompts_root + prompt, 'r', encoding='utf-8') as f:
-                self.prompt = f.read()
+            self.system, self.prompt = load_prompt(prompt, **(static_fields or {}))
         else:
-            self.prompt = prompt
+            self.system, self.prompt = None, prompt
 
         if using_cache:
-            try:
-                with open(cache_root + self.cache_name, 'r', encoding='utf-8') as f:
-                    self.cache = json.load(f)
-            except FileNotFoundError:
-                self.cache = {}
+            self.cache = CacheStore(cache_root + self.cache_name, max_bytes=component_cache_max_bytes)
+
+    def cache_key(self, prompt, image_path):
+        return cache_key(system=self.system, prompt=prompt, image=image_digest(image_path), model=self.model,
+                         online_image=self.online_image, temperature=self.temperature, max_tokens=self.max_tokens)
+
+    def prepare(self, **kwargs):
+        # -> (formatted prompt, image path)
+        image_path = kwargs.pop('image', '')
+        return self.prompt.format(**kwargs), image_path
+
+    def lookup(self, prompt, image_path):
+        if not self.using_cache:
+            return None
+        return self.cache.get(self.cache_key(prompt, image_path))
+
+    def store(self, prompt, image_path, result):
+        if self.using_cache and result is not None:
+            self.cache.put(self.cache_key(prompt, image_path), result)
+
+    def request(self, prompt, image_path):
+        # -> (OpenAI model name, chat messages) for this component
+        if self.model == 'gpt4v':
+            if self.online_image:
+                if 'http' not in image_path:
+                    image_path = imgbed_root + image_path
+                return 'gpt-4o', image_messages(prompt, image_path, self.system)
+            return 'gpt-4-vision-preview', image_messages(prompt, f"data:image/jpeg;base64,{encode_image(image_path)}",
+                                                          self.system)
+        elif self.model == 'gpt3.5':
+            return 'gpt-3.5-turbo', text_messages(prompt, self.system)
+        elif self.model == 'gpt4':
+            return 'gpt-4o', text_messages(prompt, self.system)
+        raise ValueError(f'Unknown model {self.model}')
+
+    def response_format(self, model, prompt):
+        return json_mode(model, (self.system or '') + prompt) if self.schema is not None else None
+
+    def parse(self, content):
+        if self.schema is not None:
+            value, repaired = repair_json(content)
+            if repaired:
+                telemetry.count(self.name, 'repairs')
+            content = validate(value, self.schema)
+        if self.post_process is not None:
+            return self.post_process(content)
+        return content
 
     def __call__(self, *args, **kwargs):
+        with span(self.name):
+            return self._call(**kwargs)
+
+    def _call(self, **kwargs):
         print(f'Lemma Component {self.name}: Starting...')
-        if 'image' in kwargs:
-            image_path = kwargs['image']
-            del kwargs['image']
-        else:
-            image_path = ''
-        prompt = self.prompt.format(**kwargs)
-        if self.using_cache:
-            if prompt in self.cache:
-                print(f'Lemma Component {self.name}: retrieve from cache')
-                return self.cache[prompt]
+        prompt, image_path = self.prepare(**kwargs)
+        cached = self.lookup(prompt, image_path)
+        if cached is not None:
+            print(f'Lemma Component {self.name}: retrieve from cache')
+            telemetry.cache_hit(self.name)
+            return cached
         for i in range(self.max_retry):
             try:
-                if self.model == 'gpt4v':
-                    if self.online_image:
-                        if 'http' not in image_path:
-                            image_path = imgbed_root + image_path
-                        result = onlineImg_process(prompt=prompt, url=image_path,
-                                                   max_tokens=self.max_tokens, temperature=self.temperature)
-                    else:
-                        result = offlineImg_process(prompt=prompt, image_path=image_path,
-                                                    max_tokens=self.max_tokens, temperature=self.temperature)
-                elif self.model == 'gpt3.5':
-                    result = gpt_no_image(prompt, model='gpt-3.5-turbo', max_tokens=self.max_tokens,
-                                          temperature=self.temperature)
-                elif self.model == 'gpt4':
-                    result = gpt_no_image(prompt, model='gpt-4o', max_tokens=self.max_tokens,
-                                          temperature=self.temperature)
-                else:
-                    raise ValueError(f'Unknown model {self.model}')
-                if self.post_process is not None:
-                    result = self.post_process(result)
+                model, messages = self.request(prompt, image_path)
+                result = get_transport().chat(messages, model=model, max_tokens=self.max_tokens,
+                                              temperature=self.temperature, stage=self.name,
+                                              response_format=self.response_format(model, prompt))
+                result = self.parse(result)
                 break
             except Exception as e:
                 print(f'Lemma Component {self.name}: {e}, retrying...')
+                if i < self.max_retry - 1:
+                    telemetry.retry(self.name)
+                    sleep(retry_delay(i, e))
                 continue
         else:
             print(f'Lemma Component {self.name}: Max retry exceeded')
+            telemetry.failure(self.name)
             return None
 
-        if self.using_cache and result is not None:
-            self.cache[prompt] = result
-            with open(cache_root + self.cache_name, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f)
-
+        self.store(prompt, image_path, result)
         return result
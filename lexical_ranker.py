@@ -0,0 +1,42 @@
+import math
+from collections import Counter
+from evidence_packer import terms
+
+
+class BM25:
+    """Okapi BM25 over a small set of documents, e.g. the search results of one item.
+
+    `scores` are normalized by the most a document could score for the query (every query term
+    with a very high frequency), so they fall in [0, 1) and one threshold fits queries of any length.
+    """
+    def __init__(self, documents, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents = [Counter(terms(d)) for d in documents]
+        self.lengths = [sum(d.values()) for d in self.documents]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        df = Counter(term for d in self.documents for term in d)
+        n = len(self.documents)
+        self.idf = {term: math.log(1 + (n - k + 0.5) / (k + 0.5)) for term, k in df.items()}
+
+    def score(self, query_terms, i):
+        document, length = self.documents[i], self.lengths[i]
+        total = 0.0
+        for term in query_terms:
+            tf = document.get(term, 0)
+            if tf:
+                norm = self.k1 * (1 - self.b + self.b * length / self.average_length)
+                total += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+        return total
+
+    def scores(self, query):
+        query_terms = set(terms(query))
+        ceiling = sum(self.idf[t] * (self.k1 + 1) for t in query_terms if t in self.idf)
+        if ceiling == 0:
+            return [0.0] * len(self.documents)
+        return [self.score(query_terms, i) / ceiling for i in range(len(self.documents))]
+
+
+def triage(scores, keep, drop):
+    # score -> True (clear hit), False (clear miss) or None (ambiguous, for the model to decide)
+    return [True if s >= keep else False if s <= drop else None for s in scores]
@@ -0,0 +1,268 @@
+import re
+import json
+import time
+import random
+import threading
+import httpx
+import openai
+from openai import OpenAI
+from telemetry import telemetry
+from tracing import span
+from cassette import cassette
+from configs import OPENAI_KEY, backend_concurrency, openai_rate_limits, openai_pool, retry_policy
+
+image_token_estimate = 765     # a high-detail 512x512 tile image, the common case for our posts
+completion_token_estimate = 1000     # reserved when a call does not set max_tokens
+
+
+def parse_reset(value):
+    # "1s", "6m0s", "20ms", "1h2m3.5s" -> seconds
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or ""))
+
+
+def estimate_tokens(messages, max_tokens):
+    # Rough chars/4 estimate; OpenAI counts max_tokens against the TPM limit up front
+    tokens = max_tokens if max_tokens is not None else completion_token_estimate
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // 4
+            continue
+        for part in content:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // 4
+            else:
+                tokens += image_token_estimate
+    return tokens
+
+
+def usage_dict(usage):
+    # Older openai releases do not model prompt_tokens_details and leave it a plain dict
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    return {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens,
+            "cached_tokens": cached or 0}
+
+
+def record_usage(call, usage):
+    call.prompt_tokens = usage.get("prompt_tokens", 0)
+    call.completion_tokens = usage.get("completion_tokens", 0)
+    call.cached_tokens = usage.get("cached_tokens", 0)
+
+
+def retry_after(error):
+    # Seconds the server asked us to wait in a 429/503 response, or None
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after") is not None:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def retry_delay(attempt, error=None):
+    # Exponential backoff with full jitter after the attempt-th failure (0-based), at least the Retry-After of `error`
+    delay = random.uniform(0, min(retry_policy["max"], retry_policy["base"] * 2 ** attempt))
+    waited = retry_after(error) if error is not None else None
+    return max(delay, waited) if waited is not None else delay
+
+
+class RateLimiter:
+    """Token buckets for requests/min and tokens/min of one model.
+
+    The buckets refill continuously and are corrected from the x-ratelimit-* headers of every
+    response, so several processes sharing one account still converge to the real quota.
+    """
+    def __init__(self, rpm, tpm):
+        self.lock = threading.Lock()
+        now = time.monotonic()
+        self.capacity = {"requests": float(rpm), "tokens": float(tpm)}
+        self.level = dict(self.capacity)
+        self.updated = now
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        for kind, capacity in self.capacity.items():
+            self.level[kind] = min(capacity, self.level[kind] + elapsed * capacity / 60)
+        self.updated = now
+
+    def _reserve(self, tokens):
+        # Take one request and `tokens` tokens if available, otherwise return how long to wait
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            needed = {"requests": 1.0, "tokens": min(float(tokens), self.capacity["tokens"])}
+            wait = 0.0
+            for kind, amount in needed.items():
+                if self.level[kind] < amount:
+                    wait = max(wait, (amount - self.level[kind]) * 60 / self.capacity[kind])
+            if wait > 0:
+                return wait
+            for kind, amount in needed.items():
+                self.level[kind] -= amount
+            return 0.0
+
+    def acquire(self, tokens):
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0: return
+            time.sleep(wait)
+
+    def settle(self, estimated, used):
+        # Give back what the estimate over-reserved
+        with self.lock:
+            self.level["tokens"] = min(self.capacity["tokens"], self.level["tokens"] + estimated - used)
+
+    def update(self, headers):
+        if headers is None: return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            for kind in ("requests", "tokens"):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                if limit is not None and limit.isdigit():
+                    self.capacity[kind] = float(limit)
+                if remaining is not None and remaining.isdigit():
+                    self.level[kind] = min(self.level[kind], float(remaining))
+                    if int(remaining) == 0:
+                        reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                        self.blocked_until = max(self.blocked_until, now + reset)
+            retry_after = headers.get("retry-after")
+            if retry_after is not None:
+                try: self.blocked_until = max(self.blocked_until, now + float(retry_after))
+                except ValueError: pass
+
+
+class OpenAITransport:
+    """The single OpenAI client of the project.
+
+    All calls share a keep-alive connection pool, one rate limiter per model and the
+    `backend_concurrency["openai"]` bound on calls in flight. Every request is recorded in telemetry
+    under `stage` (the model name if not given), and goes through the cassette when one is configured.
+    """
+    def __init__(self, api_key=OPENAI_KEY):
+        self.api_key = api_key
+        limits = httpx.Limits(max_connections=openai_pool["max_connections"],
+                              max_keepalive_connections=openai_pool["max_keepalive_connections"],
+                              keepalive_expiry=openai_pool["keepalive_expiry"])
+        timeout = httpx.Timeout(openai_pool["timeout"], connect=openai_pool["connect_timeout"])
+        self.client = OpenAI(api_key=api_key, http_client=httpx.Client(limits=limits, timeout=timeout))
+        self.slot = threading.BoundedSemaphore(backend_concurrency["openai"])
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+    def limiter(self, model):
+        with self.limiters_lock:
+            if model not in self.limiters:
+                limits = openai_rate_limits.get(model, openai_rate_limits["default"])
+                self.limiters[model] = RateLimiter(limits["rpm"], limits["tpm"])
+            return self.limiters[model]
+
+    def _finish(self, limiter, estimated, raw):
+        # -> {"content", "usage"}, the part of a response that cassettes record
+        limiter.update(raw.headers)
+        completion = raw.parse()
+        usage = {}
+        if completion.usage is not None:
+            limiter.settle(estimated, completion.usage.total_tokens)
+            usage = usage_dict(completion.usage)
+        return {"content": completion.choices[0].message.content, "usage": usage}
+
+    def _create(self, limiter, estimated, model, messages, max_tokens, temperature, response_format=None):
+        try:
+            raw = self.client.chat.completions.with_raw_response.create(
+                model=model, messages=messages, max_tokens=max_tokens or openai.NOT_GIVEN, temperature=temperature,
+                response_format=response_format or openai.NOT_GIVEN)
+        except openai.APIStatusError as e:
+            limiter.update(e.response.headers)
+            raise
+        return self._finish(limiter, estimated, raw)
+
+    def chat(self, messages, model, max_tokens=1000, temperature=0.1, stage=None, response_format=None):
+        request = dict(model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)
+        if response_format is not None:
+            request["response_format"] = response_format
+        limiter = self.limiter(model)
+        estimated = estimate_tokens(messages, max_tokens)
+        # A replayed call spends no quota
+        if not cassette.replays("openai"):
+            with span('rate_limit_wait', model=model):
+                limiter.acquire(estimated)
+        with self.slot, telemetry.call(stage or model) as call, span('openai', model=model, stage=stage):
+            response = cassette.call("openai", request, lambda: self._create(limiter, estimated, **request))
+            record_usage(call, response["usage"])
+            return response["content"]
+
+    def submit_batch(self, requests_path):
+        # Upload a JSONL file of /v1/chat/completions requests and start a batch job on it
+        with open(requests_path, 'rb') as f:
+            batch_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions",
+                                           completion_window="24h")
+        return batch.id
+
+    def collect_batch(self, batch_id, poll_interval=30, stage=None):
+        # Wait for a batch job to end -> {custom_id: message content} of its successful requests
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in ("completed", "failed", "expired", "cancelled"):
+                break
+            time.sleep(poll_interval)
+        contents = {}
+        if batch.output_file_id is None:
+            return contents
+        for line in self.client.files.content(batch.output_file_id).text.splitlines():
+            entry = json.loads(line)
+            response = entry.get("response") or {}
+            ok = response.get("status_code") == 200
+            usage = (response.get("body") or {}).get("usage") or {}
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            telemetry.record(stage or "batch", None, ok, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), cached)
+            if ok:
+                contents[entry["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+        return contents
+
+
+def system_messages(system):
+    return [{"role": "system", "content": system}] if system else []
+
+
+def text_messages(prompt, system=None):
+    return system_messages(system) + [{"role": "user", "content": prompt}]
+
+
+def image_messages(prompt, image_url, system=None):
+    return system_messages(system) + [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url", "image_url": {"url": image_url}},
+            ],
+        }
+    ]
+
+
+transport = None
+transport_lock = threading.Lock()
+
+
+def get_transport():
+    # Built on first use so importing the project does not require an API key
+    global transport
+    with transport_lock:
+        if transport is None:
+            # A replayed run needs no API key, but the client refuses to start without one
+            transport = OpenAITransport(OPENAI_KEY or ("replay" if cassette.replays("openai") else None))
+        return transport
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import argparse
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Drive LemmaPipeline at a fixed arrival rate, e.g. against mock_openai.py, and report throughput,
+# item latency percentiles and how the components recovered from API errors
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_file_name', type=str, default='data/twitter/twitter.json', help='Dataset whose items are sent, cycling if needed')
+parser.add_argument('--rate', type=float, default=1.0, help='Target items per second')
+parser.add_argument('--items', type=int, default=100, help='Number of items to send')
+parser.add_argument('--workers', type=int, default=32, help='Maximum number of items in flight')
+parser.add_argument('--base_url', type=str, default='http://127.0.0.1:8765/v1', help='OpenAI-compatible endpoint (empty: the real API)')
+parser.add_argument('--replay_retrieval', type=str, default=None, help='Serve DuckDuckGo, newspaper and visual search from this cassette')
+parser.add_argument('--replay_latency', type=float, default=1.0, help='With --replay_retrieval, multiple of the recorded latencies to wait')
+parser.add_argument('--fused_direct', action='store_true', default=False, help='Use the fused Direct component')
+parser.add_argument('--output', type=str, default=None, help='Also write the report as JSON to this file')
+args = parser.parse_args()
+
+# The OpenAI client reads these when the transport is first built
+if args.base_url:
+    os.environ['OPENAI_BASE_URL'] = args.base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+
+from pipeline import LemmaPipeline
+from telemetry import telemetry
+from cassette import cassette
+
+if args.replay_retrieval is not None:
+    cassette.configure(args.replay_retrieval, 'replay', latency_scale=args.replay_latency,
+                       kinds=('ddgs', 'newspaper', 'visual_search'))
+
+with open(args.input_file_name, encoding='utf-8') as f:
+    data = json.load(f)
+pipeline = LemmaPipeline(fused_direct=args.fused_direct)
+
+latencies = []
+failed = 0
+lock = threading.Lock()
+
+
+def run(item, arrival):
+    global failed
+    try:
+        record = pipeline(item)
+    except Exception:
+        record = None
+    with lock:
+        # Measured from the scheduled arrival, so time spent queued for a worker counts
+        latencies.append(time.monotonic() - arrival)
+        failed += record is None
+
+
+# Open loop: items arrive on schedule whether or not earlier ones are done
+start = time.monotonic()
+with ThreadPoolExecutor(max_workers=args.workers) as executor:
+    for i in range(args.items):
+        arrival = start + i / args.rate
+        delay = arrival - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(run, data[i % len(data)], arrival)
+elapsed = time.monotonic() - start
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+ordered = sorted(latencies)
+report = {
+    'items': args.items,
+    'failed': failed,
+    'target_rate': args.rate,
+    'throughput': len(ordered) / elapsed,
+    'elapsed': elapsed,
+    'latency_p50': percentile(ordered, 0.50),
+    'latency_p90': percentile(ordered, 0.90),
+    'latency_p99': percentile(ordered, 0.99),
+    'latency_max': ordered[-1],
+}
+print('Sent {} items at {:.2f}/s: {:.2f} items/s over {:.1f}s, {} failed'.format(
+    args.items, args.rate, report['throughput'], elapsed, failed))
+print('Item latency p50={:.2f}s p90={:.2f}s p99={:.2f}s max={:.2f}s'.format(
+    report['latency_p50'], report['latency_p90'], report['latency_p99'], report['latency_max']))
+print('Calls per stage:\n' + telemetry.summary())
+
+if args.base_url:
+    try:
+        with urllib.request.urlopen(args.base_url.rstrip('/') + '/stats', timeout=5) as response:
+            report['server'] = json.load(response)
+        print('Server responses:', report['server'])
+    except Exception:
+        pass
+
+if args.output is not None:
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
@@ -0,0 +1,88 @@
+import os
+import re
+import json
+import glob
+import argparse
+from result_log import ResultLog
+from configs import out_root
+from utils import MetricsAccumulator, save_records, pwarn
+
+# Merge the result logs of `lemma.py --shard i/N` runs (lemma_output.jsonl) or sharded test.py runs
+# (lemma_<data_name>_output.jsonl) into one log, result file and score
+parser = argparse.ArgumentParser()
+parser.add_argument('shard_dirs', nargs='*', help='Shard output directories (default: out/shard_*_of_N)')
+parser.add_argument('--num_shards', type=int, default=None, help='N of the shard_i_of_N directories to merge (needed if out/ holds runs with different N)')
+parser.add_argument('--log_name', type=str, default=None, help='Result log file in each shard directory (default: the lemma*_output.jsonl found there)')
+parser.add_argument('--input_file_name', type=str, default=None, help='Dataset file, to report items no shard has finished')
+parser.add_argument('--output_dir', type=str, default=out_root, help='Where to write the merged files')
+args = parser.parse_args()
+
+shard_dirs = sorted(args.shard_dirs or glob.glob(out_root + 'shard_*_of_{}'.format(args.num_shards or '*')))
+if not shard_dirs:
+    raise ValueError('No shard directories found')
+
+# Shards of runs split N ways cover different items, so only one N can be merged at a time
+shard_numbers = {}
+for shard_dir in shard_dirs:
+    match = re.fullmatch(r'shard_(\d+)_of_(\d+)', os.path.basename(os.path.normpath(shard_dir)))
+    if match is None:
+        raise ValueError('{} is not a shard_i_of_N directory'.format(shard_dir))
+    shard_numbers.setdefault(int(match.group(2)), set()).add(int(match.group(1)))
+if len(shard_numbers) > 1:
+    raise ValueError('Shards of runs split {} ways are mixed, choose one with --num_shards'.format(
+        ' and '.join(str(n) for n in sorted(shard_numbers))))
+num_shards, shard_indices = next(iter(shard_numbers.items()))
+if len(shard_indices) < num_shards:
+    pwarn('Shards {} of {} are missing'.format(sorted(set(range(num_shards)) - shard_indices), num_shards))
+
+# A shard without its log would silently merge as 0 items
+log_names = {args.log_name} if args.log_name else {os.path.basename(path) for shard_dir in shard_dirs
+                                                   for path in glob.glob(os.path.join(shard_dir, 'lemma*_output.jsonl'))}
+if len(log_names) != 1:
+    raise ValueError('{} result logs in the shard directories, choose one with --log_name'.format(
+        ', '.join(sorted(log_names)) if log_names else 'No'))
+log_name = log_names.pop()
+missing_logs = [shard_dir for shard_dir in shard_dirs if not os.path.exists(os.path.join(shard_dir, log_name))]
+if missing_logs:
+    raise ValueError('{} not found in {}'.format(log_name, ', '.join(missing_logs)))
+
+# Indices in the logs are dataset indices, so the shards interleave back into the original order
+records = {}
+for shard_dir in shard_dirs:
+    shard_records = ResultLog.read(os.path.join(shard_dir, log_name))
+    for index, record in shard_records.items():
+        if index in records and records[index] != record:
+            pwarn('Index {} appears in several shards, keeping the one from the first shard'.format(index))
+            continue
+        records.setdefault(index, record)
+    print('{}: {} items'.format(shard_dir, len(shard_records)))
+
+metrics = MetricsAccumulator()
+for index, record in records.items():
+    if record is not None:
+        metrics.update(record['label'], record['direct'], record['prediction'], index=index)
+
+if not os.path.exists(args.output_dir):
+    os.makedirs(args.output_dir)
+# lemma_<data_name>_output.jsonl -> lemma_<data_name>_output.json and lemma_<data_name>_score
+output_name = log_name[:-len('_output.jsonl')] if log_name.endswith('_output.jsonl') else os.path.splitext(log_name)[0]
+output_log = os.path.join(args.output_dir, log_name)
+result_log = ResultLog(output_log)
+for index in sorted(records):
+    result_log.append(index, records[index])
+result_log.close()
+# The score needs at least one scored item
+if len(metrics):
+    save_records(records, metrics, os.path.join(args.output_dir, output_name + '_output.json'), os.path.join(args.output_dir, output_name + '_score'))
+else:
+    pwarn('No scored items, {0}_output.json and {0}_score are not written'.format(output_name))
+
+print('Merged {} items ({} skipped by their components) into {}'.format(len(records), len(records) - len(metrics), args.output_dir))
+if len(metrics):
+    print(metrics.stats_text())
+if args.input_file_name is not None:
+    with open(args.input_file_name, encoding='utf-8') as f:
+        total_data_size = len(json.load(f))
+    missing = [index for index in range(total_data_size) if index not in records]
+    if missing:
+        pwarn('{} of {} items are missing, first ones: {}'.format(len(missing), total_data_size, missing[:20]))
@@ -0,0 +1,211 @@
+import re
+import json
+import math
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the OpenAI chat completions endpoint, for concurrency and rate limit tuning.
+# Point the project at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 (any OPENAI_API_KEY works).
+# It answers every LEMMA prompt with canned JSON of the expected shape, after a latency drawn from
+# --latency, and can inject 429s (with Retry-After and x-ratelimit-* headers) and 5xx errors.
+# Like the real API, a repeated system message of 1024+ tokens is reported as cached_tokens.
+# GET /stats returns the request counts by outcome.
+
+
+def parse_latency(spec):
+    # "fixed:0.5", "uniform:0.2,1.5", "exp:0.8" (mean) or "lognormal:0.8,0.5" (median, sigma) -> sampler
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',') if v]
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'exp':
+        return lambda rng: rng.expovariate(1 / values[0])
+    if kind == 'lognormal':
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f'Unknown latency distribution {spec}')
+
+
+def prompt_text(messages):
+    parts = []
+    for message in messages:
+        content = message['content']
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(part['text'] for part in content if part['type'] == 'text')
+    return '\n'.join(parts)
+
+
+def count_images(messages):
+    return sum(1 for message in messages if not isinstance(message['content'], str)
+               for part in message['content'] if part['type'] != 'text')
+
+
+def canned_answer(prompt, rng):
+    # Recognize the prompt by its wording and answer in the format its parser expects
+    if 'external explanation' in prompt:
+        return json.dumps({'label': rng.choice(['real', 'fake']), 'explanation': 'The image is consistent with the text.',
+                           'external knowledge': rng.choice(['Yes', 'No']),
+                           'external explanation': 'The event in the text can only be confirmed with external sources.'})
+    if 'additional evidence is needed' in prompt:
+        return json.dumps({'explanation': 'The event in the text can only be confirmed with external sources.',
+                           'external knowledge': rng.choice(['Yes', 'Yes', 'No'])})
+    if 'come up with a title' in prompt:
+        return json.dumps({'title': 'A news title', 'questions': ['What happened at the event?', 'Is the image authentic?']})
+    if 'predefined categories' in prompt:
+        category = rng.choice(['true', 'satire/parody', 'misleading content', 'text image contradiction',
+                               'manipulated content', 'unverified'])
+        return 'The references support this conclusion.\n' + category
+    if 'filter the off-topic search result' in prompt:
+        ids = sorted(set(int(i) for i in re.findall(r'"(\d+)": \{', prompt)))
+        return json.dumps({str(i): rng.random() < 0.7 for i in ids})
+    if '**Documents**' in prompt:
+        ids = re.findall(r'"(\d+)": "', prompt.split('**Documents**')[-1])
+        return json.dumps({i: 'A relevant quote from the document.' if rng.random() < 0.7 else '' for i in ids})
+    if 'predict whether misinformation is present' in prompt:
+        return json.dumps({'label': rng.choice(['real', 'fake']), 'explanation': 'The image is consistent with the text.'})
+    return 'OK'
+
+
+class MockState:
+    def __init__(self, args):
+        self.args = args
+        self.latency = parse_latency(args.latency)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.window = []     # start times of the requests of the last minute, for --rpm
+        self.prefixes = set()   # digests of the system messages seen so far, for cached_tokens
+
+    def admit(self, now):
+        # -> (allowed, remaining requests, seconds until a slot frees) under the --rpm limit
+        with self.lock:
+            self.window = [t for t in self.window if now - t < 60]
+            if self.args.rpm and len(self.window) >= self.args.rpm:
+                return False, 0, 60 - (now - self.window[0])
+            self.window.append(now)
+            remaining = self.args.rpm - len(self.window) if self.args.rpm else 1000000
+            reset = 60 - (now - self.window[0]) if self.args.rpm else 0
+            return True, remaining, reset
+
+    def cached_tokens(self, messages):
+        # Prompt caching: prefixes of 1024+ tokens, in steps of 128, hit once seen
+        system = ''.join(m['content'] for m in messages if m['role'] == 'system' and isinstance(m['content'], str))
+        tokens = len(system) // 4
+        if tokens < 1024:
+            return 0
+        digest = hashlib.sha256(system.encode('utf-8')).hexdigest()
+        with self.lock:
+            seen = digest in self.prefixes
+            self.prefixes.add(digest)
+        return tokens // 128 * 128 if seen else 0
+
+    def count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.state.lock:
+                self.send_json(200, dict(self.state.stats))
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'not found'}})
+            return
+        state, args = self.state, self.state.args
+        messages = body.get('messages', [])
+        prompt = prompt_text(messages)
+        rng = random.Random()
+        # Answers depend only on the prompt, so repeated runs see the same outputs
+        answer_rng = random.Random(hashlib.sha256(prompt.encode('utf-8')).hexdigest())
+
+        rate_limited = {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+        if rng.random() < args.rate_429:
+            state.count('429')
+            self.send_json(429, rate_limited, {'retry-after': str(args.retry_after)})
+            return
+        allowed, remaining, reset = state.admit(time.monotonic())
+        limit_headers = {'x-ratelimit-limit-requests': str(args.rpm or 1000000),
+                         'x-ratelimit-remaining-requests': str(remaining),
+                         'x-ratelimit-reset-requests': '{:.3f}s'.format(max(0.0, reset))}
+        if not allowed:
+            state.count('429')
+            self.send_json(429, rate_limited, dict(limit_headers, **{'retry-after': str(max(1, math.ceil(reset)))}))
+            return
+        if rng.random() < args.rate_5xx:
+            state.count('5xx')
+            time.sleep(state.latency(rng) * 0.5)
+            self.send_json(rng.choice([500, 502, 503]), {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+            return
+
+        time.sleep(state.latency(rng))
+        content = canned_answer(prompt, answer_rng)
+        prompt_tokens = len(prompt) // 4 + 765 * count_images(messages)
+        completion_tokens = len(content) // 4
+        state.count('ok')
+        self.send_json(200, {
+            'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': body.get('model'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens,
+                      'prompt_tokens_details': {'cached_tokens': state.cached_tokens(messages)}},
+        }, limit_headers)
+
+
+def serve(args):
+    Handler.state = MockState(args)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=str, default='lognormal:1.5,0.5', help='fixed:S, uniform:A,B, exp:MEAN or lognormal:MEDIAN,SIGMA (seconds)')
+    parser.add_argument('--rate_429', type=float, default=0.0, help='Fraction of requests answered with 429')
+    parser.add_argument('--rate_5xx', type=float, default=0.0, help='Fraction of requests answered with 500/502/503')
+    parser.add_argument('--retry_after', type=int, default=1, help='Retry-After seconds of injected 429s')
+    parser.add_argument('--rpm', type=int, default=0, help='Requests per minute before answering 429 (0: unlimited)')
+    parser.add_argument('--verbose', action='store_true', default=False)
+    args = parser.parse_args()
+
+    server = serve(args)
+    print('Mock OpenAI server on http://{}:{}/v1'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(dict(Handler.state.stats))
@@ -0,0 +1,104 @@
+import random
+import hashlib
+from urllib.parse import urlparse, parse_qsl, urlencode
+from evidence_packer import word_pattern
+
+# MinHash signatures with LSH banding, to find near-duplicate search results (syndicated copies of
+# one story under slightly different titles, bodies or URLs) without comparing every pair.
+
+mersenne = (1 << 61) - 1
+
+
+def base_hash(shingle):
+    # Stable across processes, unlike hash()
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class MinHash:
+    def __init__(self, num_perm=64, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, mersenne), rng.randrange(0, mersenne)) for _ in range(num_perm)]
+
+    def signature(self, shingles):
+        hashes = [base_hash(s) for s in shingles] or [0]
+        return tuple(min((a * h + b) % mersenne for h in hashes) for a, b in self.permutations)
+
+
+def similarity(a, b):
+    # Estimated Jaccard similarity of the shingle sets behind two signatures
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+
+def shingles(text, k=2):
+    words = word_pattern.findall(text.lower())
+    if len(words) < k:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+tracking_parameters = {'fbclid', 'gclid', 'dclid', 'msclkid', 'yclid', 'igshid', 'mc_cid', 'mc_eid', 'ref', 'ref_src'}
+
+
+def normalize_url(url):
+    # Same page behind tracking parameters, a www. prefix or a trailing slash; other query
+    # parameters (?v=..., ?id=...) select different pages and are kept
+    parsed = urlparse(url or '')
+    host = parsed.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+             if not k.lower().startswith('utm_') and k.lower() not in tracking_parameters]
+    normalized = host + parsed.path.rstrip('/')
+    return normalized + '?' + urlencode(sorted(query)) if query else normalized
+
+
+class NearDuplicates:
+    """Clusters of near-duplicate documents: same normalized URL, same title, or MinHash similarity
+    of title and body shingles at least `threshold`, found through `bands` LSH bands.
+
+    `representatives(documents)` takes (title, body, url) tuples and returns, for each document, the
+    index of the first document of its cluster.
+    """
+    def __init__(self, threshold=0.6, num_perm=64, bands=16):
+        if num_perm % bands:
+            raise ValueError('num_perm must be a multiple of bands')
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.minhash = MinHash(num_perm)
+
+    def representatives(self, documents):
+        parent = list(range(len(documents)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(i, j):
+            i, j = find(i), find(j)
+            # The earlier document represents the cluster
+            if i != j:
+                parent[max(i, j)] = min(i, j)
+
+        document_shingles = [shingles(f'{title} {body}') for title, body, _ in documents]
+        signatures = [self.minhash.signature(s) for s in document_shingles]
+        exact = {}
+        buckets = {}
+        for i, (title, _, url) in enumerate(documents):
+            for key in (('url', normalize_url(url)), ('title', ' '.join(word_pattern.findall(title.lower())))):
+                if key[1]:
+                    if key in exact:
+                        union(exact[key], i)
+                    exact.setdefault(key, i)
+            # A result without words has nothing to compare, only its URL
+            if not document_shingles[i]:
+                continue
+            for band in range(self.bands):
+                bucket = (band, signatures[i][band * self.rows:(band + 1) * self.rows])
+                for j in buckets.get(bucket, []):
+                    if find(i) != find(j) and similarity(signatures[i], signatures[j]) >= self.threshold:
+                        union(i, j)
+                buckets.setdefault(bucket, []).append(i)
+        return [find(i) for i in range(len(documents))]
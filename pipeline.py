@@ -0,0 +1,181 @@
+import traceback
+from lemma_component import LemmaComponent
+from retrieval import get_evidence, visual_search
+from configs import definition_path
+from utils import process_multilines_output, perror
+from tracing import span
+
+rumor_types = ["true", "satire/parody", "misleading content", "text image contradiction", "manipulated content", "unverified"]
+
+# Keys and types of the JSON answer of each component
+direct_schema = {'label': str, 'explanation': str}
+fused_direct_schema = {'label': str, 'explanation': str, 'external knowledge': str, 'external explanation': str}
+external_knowledge_schema = {'explanation': str, 'external knowledge': str}
+question_gen_schema = {'title': str, 'questions': list}
+
+
+def direct_prediction(direct):
+    return 0 if "real" in direct['label'].lower() else 1
+
+
+def fused_decision(direct):
+    # The external-knowledge decision embedded in a fused Direct answer
+    return {'explanation': direct.get('external explanation', direct['explanation']),
+            'external knowledge': direct['external knowledge']}
+
+
+def needs_external(decision_external):
+    direct_external = 0 if "no" in decision_external['external knowledge'].lower() else 1
+    print("######################")
+    print("Need External Knowledge:", direct_external)
+    print(decision_external['explanation'])
+    print("######################")
+    return direct_external == 1
+
+
+class LemmaPipeline:
+    """Direct -> external_knowledge -> question_gen -> retrieval -> refine chain for a single item.
+
+    Calling the pipeline on a dataset item returns the log record of that item, or None if a
+    component gave up. It holds no per-item state, so several items can run through it at once.
+    The step methods are shared with stage_runner.StageRunner, which runs them stage by stage.
+    With `fused_direct`, one call to lemma_direct_fused.md returns both the Direct prediction and the
+    external-knowledge decision.
+    """
+    def __init__(self, use_cache=False, online_image=True, fused_direct=False):
+        self.fused_direct = fused_direct
+        with open(definition_path, 'r', encoding='utf-8') as f:
+            definition = f.read()
+        self.direct_module = LemmaComponent(prompt='lemma_direct.md', name='Direct', model='gpt4v', using_cache=use_cache,
+                                            online_image=online_image, max_retry=3, max_tokens=1000, temperature=0.1,
+                                            schema=direct_schema)
+        self.fused_direct_module = LemmaComponent(prompt='lemma_direct_fused.md', name='Direct_fused', model='gpt4v', using_cache=use_cache,
+                                                  online_image=online_image, max_retry=3, max_tokens=1000, temperature=0.1,
+                                                  schema=fused_direct_schema)
+        self.external_knowledge_module = LemmaComponent(prompt='external_knowledge.md', name='external_knowledge',
+                                                        model='gpt4v', using_cache=use_cache,
+                                                        online_image=online_image, max_retry=3, max_tokens=1000, temperature=0.1,
+                                                        schema=external_knowledge_schema)
+        self.question_gen_module = LemmaComponent(prompt='question_gen.md', name='question_gen', model='gpt4v', using_cache=use_cache,
+                                                  online_image=online_image, max_retry=3, max_tokens=1000, temperature=0.1,
+                                                  schema=question_gen_schema)
+        self.refine_prediction_module = LemmaComponent(prompt='refined_prediction.md', name='modify_reasoning', model='gpt4v',
+                                                       using_cache=use_cache,
+                                                       online_image=online_image, max_retry=3, max_tokens=1000, temperature=0.1,
+                                                       post_process=process_multilines_output,
+                                                       static_fields=dict(DEFINITION=definition))
+
+    @property
+    def first_module(self):
+        return self.fused_direct_module if self.fused_direct else self.direct_module
+
+    # Inputs of each component for one item
+    def direct_inputs(self, item):
+        return dict(TEXT=item["original_post"], image=item["image_url"])
+
+    def external_inputs(self, item, direct):
+        return dict(REASONING=direct['explanation'], TEXT=item["original_post"], image=item["image_url"])
+
+    def question_inputs(self, item, direct):
+        return dict(TEXT=item["original_post"], PREDICTION=direct_prediction(direct), REASONING=direct['explanation'],
+                    image=item["image_url"])
+
+    def refine_inputs(self, item, direct, retrieval):
+        return dict(TEXT=item["original_post"], ORIGINAL_REASONING=direct['explanation'],
+                    EXTERNAL=retrieval['text'], EXTERNAL_VISUAL=retrieval['visual'], image=item["image_url"])
+
+    def retrieve(self, item, question_gen):
+        with span('retrieval'):
+            return self._retrieve(item, question_gen)
+
+    def _retrieve(self, item, question_gen):
+        # Evidence Retrieval
+        print("Lemma Component Evidence Retrieval: Starting...")
+        url = item["image_url"]
+        text = item["original_post"]
+        title, questions = question_gen['title'], question_gen['questions']
+        try:
+            retrieved_text = get_evidence(text, title, questions)
+        except Exception as e:
+            perror(traceback.format_exc())
+            retrieved_text = ""
+
+        try:
+            visual_retrieved_text = visual_search(url, text)
+        except Exception as e:
+            perror(traceback.format_exc())
+            visual_retrieved_text = ""
+        return {'text': retrieved_text, 'visual': visual_retrieved_text}
+
+    def record(self, item, direct, refine_result=None, retrieval=None):
+        # Log record of an item from its component outputs; items without retrieval have no refine_result
+        url = item["image_url"]
+        text = item["original_post"]
+        label = item["label"]
+        direct_pred = direct_prediction(direct)
+        direct_explain = direct['explanation']
+
+        retrieved_text = None
+        if refine_result is not None:
+            # Result Postprocessing
+            refined_pred = refine_result["label"]
+            refined_explain =  refine_result
+
+            for rumor_type in rumor_types:
+                if rumor_type.lower() in refined_pred.lower():
+                    refined_pred = rumor_type
+                    break
+            if refined_pred == 'true':
+                final_pred = 0
+            elif refined_pred == 'unverified':
+                final_pred = direct_pred   # If model is not sure, go back to direct prediction
+            else:
+                final_pred = 1
+            print('Refined Prediction:', refined_pred)
+            final_explain = refined_explain
+            retrieved_text = retrieval['text'] + retrieval['visual']
+
+        else:
+            final_pred = direct_pred
+            final_explain = direct_explain
+
+        print('\nLabel:', label, ', Refined Prediction:', final_pred, ', Direct:', direct_pred)
+        print('Refined Explain:', final_explain)
+
+        return {
+            'text': text,
+            'image_url': url,
+            'tool_learning_text': retrieved_text,
+            'label': label,
+            'prediction': final_pred,
+            'explain': final_explain,
+            'direct': direct_pred,
+            'direct_explain': direct_explain,
+        }
+
+    def __call__(self, item):
+        # Direct Prediction
+        direct = self.first_module(**self.direct_inputs(item))
+        print(direct)
+        if direct is None: return None
+
+        # External Knowledge
+        # Decide whether external knowledge is needed to further examine the input sample
+        if self.fused_direct:
+            decision_external = fused_decision(direct)
+        else:
+            decision_external = self.external_knowledge_module(**self.external_inputs(item, direct))
+        if decision_external is None: return None
+        if not needs_external(decision_external):
+            return self.record(item, direct)
+
+        # Query Generation
+        question_gen = self.question_gen_module(**self.question_inputs(item, direct))
+        if question_gen is None: return None
+
+        retrieval = self.retrieve(item, question_gen)
+
+        # Refined Prediction
+        refine_result = self.refine_prediction_module(**self.refine_inputs(item, direct, retrieval))
+        if refine_result is None: return None
+        return self.record(item, direct, refine_result, retrieval)
@@ -0,0 +1,106 @@
+import re
+import threading
+from functools import lru_cache
+from configs import region_detection
+
+# DuckDuckGo region of a search query, from its language; anything unmapped searches us-en
+region_map = {
+    'en': 'us-en',
+    # 'ca': 'ct-ca',
+    'zh': 'tw-tzh',
+    'zh-cn': 'tw-tzh',
+    'zh-tw': 'tw-tzh',
+    # 'fr': 'fr-fr',
+    # 'tr': 'tr-tr',
+    # 'nl': 'nl-nl',
+}
+
+url_pattern = re.compile(r"https?://\S+|www\.\S+|@\w+|#")
+han_pattern = re.compile(r"[\u4e00-\u9fff\u3400-\u4dbf]")
+kana_pattern = re.compile(r"[\u3040-\u30ff]")
+hangul_pattern = re.compile(r"[\uac00-\ud7af\u1100-\u11ff]")
+english_words = set("""the a an and of to in is are was were for on with that this it as at by from be has have
+not but or you he she they we his her their its what who how why when will can new after about says""".split())
+
+
+def normalize(text):
+    # Memo key: links and mentions say little about the language
+    text = url_pattern.sub(' ', text or '')
+    return ' '.join(text.split()).lower()[:500]
+
+
+class RegionDetector:
+    """Language and DuckDuckGo region of search queries.
+
+    Obvious cases are settled without langdetect: plain ASCII text in which a quarter of the words
+    are English function words is English, and Han, kana or Hangul text is Chinese, Japanese or
+    Korean. The rest goes to a langdetect profile loaded once with a fixed seed, so a text always
+    gets the same answer.
+    Answers are memoized by normalized text. Text without letters, or that langdetect cannot
+    handle, falls back to `default`.
+    """
+    def __init__(self, seed=0, memo_size=4096, default='en'):
+        self.seed = seed
+        self.default = default
+        self.factory = None
+        self.factory_lock = threading.Lock()
+        self.language = lru_cache(maxsize=memo_size)(self.detect_normalized)
+
+    def get_factory(self):
+        # Loading the profiles takes a while, so it happens once, on the first query that needs it
+        with self.factory_lock:
+            if self.factory is None:
+                from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+                factory = DetectorFactory()
+                factory.load_profile(PROFILES_DIRECTORY)
+                factory.set_seed(self.seed)
+                self.factory = factory
+            return self.factory
+
+    def script_language(self, text):
+        # -> language from the characters alone, or None if the model has to decide
+        if not any(c.isalpha() for c in text):
+            return self.default
+        if text.isascii():
+            words = re.findall(r"[a-z]+", text)
+            if len(words) < 3 or sum(w in english_words for w in words) * 4 >= len(words):
+                return 'en'
+            return None
+        if kana_pattern.search(text):
+            return 'ja'
+        if hangul_pattern.search(text):
+            return 'ko'
+        if han_pattern.search(text):
+            return 'zh'
+        return None
+
+    def detect_normalized(self, text):
+        language = self.script_language(text)
+        if language is not None:
+            return language
+        try:
+            detector = self.get_factory().create()
+            detector.append(text)
+            return detector.detect()
+        except Exception:
+            # langdetect raises on text it finds no features in; a missing profile must not stop a search either
+            return self.default
+
+    def detect(self, text):
+        return self.language(normalize(text))
+
+    def detect_many(self, texts):
+        # Batch of one item's queries: each distinct normalized text is detected once
+        normalized = [normalize(t) for t in texts]
+        languages = {n: self.language(n) for n in set(normalized)}
+        return [languages[n] for n in normalized]
+
+    def region(self, text):
+        return region_map.get(self.detect(text), 'us-en')
+
+    def regions(self, texts):
+        return [region_map.get(language, 'us-en') for language in self.detect_many(texts)]
+
+
+# Shared by all search threads of the process
+region_detector = RegionDetector(**region_detection)
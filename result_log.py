@@ -0,0 +1,54 @@
+import os
+import json
+import threading
+
+
+class ResultLog:
+    """Append-only JSONL log of finished items, one {"index": i, "record": {...}} per line.
+
+    Every line is flushed and fsync'd before `append` returns, so after a crash the log holds every
+    finished item and at worst one truncated last line, which `read` skips. A record of None marks
+    an item whose components gave up.
+    """
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.lock = threading.Lock()
+        if resume and os.path.exists(path):
+            # Terminate a line cut off by a crash so the next record starts on its own line; checked in
+            # binary since the cut may fall inside a multibyte character
+            cut = False
+            with open(path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    cut = f.read(1) != b'\n'
+            self.file = open(path, 'a', encoding='utf-8')
+            if cut:
+                self.file.write('\n')
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+
+    def append(self, index, record):
+        line = json.dumps({'index': index, 'record': record}, ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        # index -> record, later lines win
+        records = {}
+        if not os.path.exists(path):
+            return records
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    continue
+                records[entry['index']] = entry['record']
+        return records
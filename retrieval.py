@@ -1,81 +1,157 @@
-import re
 import os
 import json
+import time
+import queue
+import threading
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from newspaper import Article
+from newspaper import Article, Config
+from newspaper.article import ArticleDownloadState, ArticleException
 from duckduckgo_search import DDGS
 from duckduckgo_search.exceptions import DuckDuckGoSearchException
 
-import openai
-from openai import OpenAI
-
-from utils import predict_region, pwarn
-from configs import prompts_root,OPENAI_KEY, out_root, imgbed_root
+from utils import pwarn, backend_slot, load_prompt
+from llm_transport import get_transport, text_messages
+from cache_store import CacheStore, SingleFlight, cache_key, image_digest
+from browser_pool import DriverPool, StepTimeout, wait_for
+from telemetry import telemetry
+from tracing import span, traced
+from cassette import cassette, CassetteMiss, ReplayedError
+from structured_output import repair_json, json_mode
+from evidence_packer import pack, count_tokens
+from lexical_ranker import BM25, triage
+from near_duplicates import NearDuplicates
+from domain_index import DomainIndex
+from region_detection import region_detector
+from configs import out_root, imgbed_root, cache_root, browser_pool, visual_search_deadlines, scraper_policy, backend_concurrency, article_cache_ttl, search_policy, evidence_budget, topic_filter_policy, near_duplicate_policy, untrusted_sources, source_blocklists
 from urllib.parse import urlparse
 
-import pyautogui
-from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.by import By
-
-# Initialize the Chrome webdriver
-# check online docs for selenium if any error is thrown here
-options = webdriver.ChromeOptions()     # Find the chromederver suitable for your chrome version here: https://googlechromelabs.github.io/chrome-for-testing/#stable, put it under the same directory as this script
-options.add_argument("--lang=en")
-driver = webdriver.Chrome(options=options)
-
-# Setup OpenAI API
-openai.api_key = OPENAI_KEY
-client = OpenAI()
-
-untrusted_sources={"www.reddit.com","www.weibo.com","twitter.com","www.tiktok.com","www.douyin.com","www.instagram.com","www.taobao.com","www.jd.com","www.amazon.com","www.ebay.com","www.imdb.com","www.douban.com","steamcommunity.com","m.ixigua.com","www.bilibili.com","www.netflix.com",}
-
-is_first_call = True
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+# Blocked result domains, shared by text_search and visual_search; extended by configure_retrieval(blocklists=...)
+source_index = DomainIndex(untrusted_sources)
+
+# Prompts of the tool calls, split into a fixed system prefix and a per-call template
+topic_filter_system, topic_filter_prompt = load_prompt('topic_relevance_filter.md')
+evidence_extraction_system, evidence_extraction_prompt = load_prompt('evidence_extraction.md')
+
+search_log_lock = threading.Lock()
+search_log_path = out_root + "search_results.jsonl"
+
+# Reverse image search results, keyed by image content; enabled by configure_retrieval(use_cache=True)
+visual_search_cache = None
+visual_search_flight = SingleFlight()
+# Parsed articles and failed fetches, keyed by url; enabled by configure_retrieval(use_cache=True)
+article_cache = None
+# DuckDuckGo results, keyed by (query, region, query_type, top_k); enabled by configure_retrieval(use_cache=True)
+search_cache = None
+
+
+# Chrome drivers for visual_search, started on first use
+# check online docs for selenium if any error is thrown when a driver starts
+driver_pool = None
+driver_pool_options = dict(browser_pool)
+driver_pool_lock = threading.Lock()
+
+
+def configure_retrieval(use_cache=False, browser_pool_size=None, headless=None, output_dir=None, blocklists=()):
+    global visual_search_cache, article_cache, search_cache, search_log_path
+    for path in list(source_blocklists) + list(blocklists):
+        print("Loaded {} blocked domains from {}".format(source_index.load(path), path))
+    if output_dir is not None:
+        search_log_path = output_dir + "search_results.jsonl"
+    visual_search_cache = CacheStore(cache_root + "visual_search.sqlite") if use_cache else None
+    article_cache = CacheStore(cache_root + "articles.sqlite", compress=True) if use_cache else None
+    search_cache = CacheStore(cache_root + "text_search.sqlite", compress=True) if use_cache else None
+    if browser_pool_size is not None:
+        driver_pool_options["size"] = browser_pool_size
+    if headless is not None:
+        driver_pool_options["headless"] = headless
+
+
+def get_driver_pool():
+    global driver_pool
+    with driver_pool_lock:
+        if driver_pool is None:
+            headless = driver_pool_options["headless"]
+            # Nobody can solve a reCAPTCHA in a headless browser, so only check for it there
+            verification_timeout = 0 if headless else 300
+            driver_pool = DriverPool(size=driver_pool_options["size"], headless=headless,
+                                     recycle_after=driver_pool_options["recycle_after"],
+                                     page_load_timeout=driver_pool_options["page_load_timeout"],
+                                     on_create=lambda driver: human_verification(driver, verification_timeout))
+        return driver_pool
 
 def source_filter(results):
-    global untrusted_sources
-    if results == None or results == []:
-        return []
-    for result in results:
-        link=result['href']
-        domain = re.search('https?://([A-Za-z_0-9.-]+).*', link).group(1)
-        if domain in untrusted_sources:   
-            results.remove(result)
-    return results
+    return source_index.filter(results)
 
 
-def topic_relevance_filter(text, all_results, top_k, query_set, cutoff_index=150):
+@traced()
+def topic_relevance_filter(text, all_results, top_k, query_set, cutoff_index=150, log=None):
     # Structure flattern
     all_results_flatterned = []
-    for qid, query in enumerate(all_results.keys()):
-        results= all_results[query]
-        for i,result in enumerate(results):
+    for qid, query in enumerate(query_set):
+        if query in query_set[:qid]: continue
+        for i,result in enumerate(all_results.get(query, [])):
             id = qid*top_k + i        # we can use id//top_k to determine which query it belongs later
-            result['body']=result['body'][:cutoff_index]
-            all_results_flatterned.append({id:result})
+            all_results_flatterned.append((id, result))
+
+    # Local pre-ranking: clear hits are kept and clear misses dropped without asking the model
+    scores = BM25([f"{result['title']} {result['body']}" for _, result in all_results_flatterned]).scores(text)
+    if topic_filter_policy["prerank"]:
+        decisions = triage(scores, topic_filter_policy["keep"], topic_filter_policy["drop"])
+    else:
+        decisions = [None] * len(scores)
+    relevance_labels = {id: decision for (id, _), decision in zip(all_results_flatterned, decisions) if decision is not None}
+    ambiguous = [(id, result) for (id, result), decision in zip(all_results_flatterned, decisions) if decision is None]
+    print("Topic relevance filter: {} kept, {} dropped locally, {} sent to the model".format(
+        decisions.count(True), decisions.count(False), len(ambiguous)))
+    if ambiguous:
+        relevance_labels.update(model_relevance_labels(text, ambiguous, cutoff_index))
+    else:
+        telemetry.count("topic_relevance_filter", "skipped_calls")
+
+    if log is not None:
+        log["relevance"] = [{"id": id, "query": query_set[id//top_k], "title": result['title'], "score": round(score, 4),
+                             "label": relevance_labels.get(id, False), "by": "prerank" if decision is not None else "model"}
+                            for (id, result), score, decision in zip(all_results_flatterned, scores, decisions)]
+
+    # Filter the results and restructure the results
+    all_filtered_results = {}  
+    for query in query_set:
+        all_filtered_results[query]=[]
+    for id, result in all_results_flatterned:
+        if relevance_labels.get(id)==True:
+            qid=id//top_k               # use id//top_k to determine which query it belongs
+            query=query_set[qid]
+            all_filtered_results[query].append(result)
+    return all_filtered_results
+
 
+def model_relevance_labels(text, results, cutoff_index=150):
+    # results: [(id, search result)] -> {id: relevant} from gpt-4-turbo
     # Prompt formation
     text=text[:cutoff_index+50]
-    with open(prompts_root+'topic_relevance_filter.md', 'r', encoding='utf-8') as f: 
-        prompt=f.read()
-    prompt=prompt.format(TEXT=text, SEARCH_RESULT=json.dumps(all_results_flatterned, ensure_ascii=False, indent=4))
+    entries = [{id: dict(result, body=result['body'][:cutoff_index])} for id, result in results]
+    prompt=topic_filter_prompt.format(TEXT=text, SEARCH_RESULT=json.dumps(entries, ensure_ascii=False, indent=4))
 
     # GPT Query
-    completion = client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.1
-    )
-    response = completion.choices[0].message.content
+    response = get_transport().chat(text_messages(prompt, topic_filter_system), model="gpt-4-turbo", max_tokens=None,
+                                    temperature=0.1, stage="topic_relevance_filter",
+                                    response_format=json_mode("gpt-4-turbo", topic_filter_system + prompt))
 
     # Post process
     try:
-        relevance_labels=json.loads(response)
+        relevance_labels, repaired = repair_json(response)
+        if repaired: telemetry.count("topic_relevance_filter", "repairs")
     except:
         pwarn("Tool learning Warning: Invalid response from topic_relevance_filter. Remain unchanged.")
-        return results
+        telemetry.failure("topic_relevance_filter")
+        return {id: True for id, _ in results}
     
     # Wash the string keys to int, and remove the non-integer keys
     temp = {}
@@ -85,68 +161,235 @@ def topic_relevance_filter(text, all_results, top_k, query_set, cutoff_index=150
                 id=int(id)
             else: continue
         temp[id] = value
-    relevance_labels = temp
-        
-    # Filter the results and restructure the results
-    all_filtered_results = {}  
-    for query in query_set:
-        all_filtered_results[query]=[]
-    for temp in all_results_flatterned:
-        id, result = list(temp.items())[0]
-        if id in relevance_labels and relevance_labels[id]==True:
-            qid=id//top_k               # use id//top_k to determine which query it belongs
-            query=query_set[qid]
-            all_filtered_results[query].append(result)
-    return all_filtered_results
-
-
-def scraper(url, max_len=2000):
-    if url == None or url == "" or "http" not in url:
-        return ""
-    
+    return temp
+
+
+class DomainGate:
+    """Per-domain concurrency limit and backoff for the scraper.
+
+    A failing domain is backed off exponentially while downloads from other domains go on.
+    """
+    def __init__(self, per_domain, backoff, max_backoff):
+        self.per_domain = per_domain
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.failures = {}
+        self.retry_at = {}
+
+    def slot(self, domain):
+        with self.lock:
+            if domain not in self.semaphores:
+                self.semaphores[domain] = threading.BoundedSemaphore(self.per_domain)
+            return self.semaphores[domain]
+
+    def wait(self, domain, give_up_at=None):
+        # -> False, without waiting, if the domain is backed off beyond give_up_at (time.monotonic())
+        with self.lock:
+            retry_at = self.retry_at.get(domain, 0)
+        if give_up_at is not None and retry_at >= give_up_at:
+            return False
+        delay = retry_at - time.monotonic()
+        if delay > 0:
+            with span('scraper_backoff', domain=domain):
+                sleep(delay)
+        return True
+
+    def failed(self, domain):
+        with self.lock:
+            self.failures[domain] = self.failures.get(domain, 0) + 1
+            delay = min(self.max_backoff, self.backoff * 2 ** (self.failures[domain] - 1))
+            self.retry_at[domain] = time.monotonic() + delay
+
+    def succeeded(self, domain):
+        with self.lock:
+            self.failures.pop(domain, None)
+            self.retry_at.pop(domain, None)
+
+
+scrape_gate = DomainGate(scraper_policy["per_domain"], scraper_policy["backoff"], scraper_policy["max_backoff"])
+# A download still running when its batch deadline passes cannot be cancelled; it is bounded by
+# newspaper's request_timeout and makes no further attempt, so its thread is soon free again. Twice the download slots
+# leave room for the next item's downloads meanwhile.
+scrape_executor = ThreadPoolExecutor(max_workers=backend_concurrency["scraper"] * 2, thread_name_prefix="scraper")
+newspaper_config = Config()
+newspaper_config.request_timeout = (scraper_policy["connect_timeout"], scraper_policy["read_timeout"])
+
+
+def download_html(article):
+    article.download()
+    if article.download_state != ArticleDownloadState.SUCCESS:
+        raise ArticleException(article.download_exception_msg)
+    return article.html
+
+
+def download(article):
+    # With a cassette, the page html is recorded or replayed; a failed download is recorded as an error
+    if not cassette.active("newspaper"):
+        article.download()
+        return
+    article.download(input_html=cassette.call("newspaper", dict(url=article.url), lambda: download_html(article)))
+
+
+@traced()
+def fetch_article(url, give_up_at=None):
+    # Download and parse one page: {"status": "ok" | "failed", "publish_date", "text", "fetched_at"},
+    # or None if it was given up at give_up_at (time.monotonic()) before a successful download
     try:
-        article = Article(url)
+        article = Article(url, config=newspaper_config)
     except Exception as e:
         pwarn(f"Tool learning Warning: scraper failed on {url}. {e}")
-        return ""
-    try: article.download()
-    except Exception as e:
-        sleep(10)
-        try: article.download()
-        except:
-            pwarn(f"Tool learning Warning: scraper failed on {url}. {e}")
-            return ""
+        telemetry.failure("scraper")
+        return {"status": "failed", "publish_date": None, "text": "", "fetched_at": time.time()}
+    domain = urlparse(url).hostname or ""
+    for attempt in range(scraper_policy["attempts"]):
+        if give_up_at is not None and time.monotonic() >= give_up_at:
+            return None
+        if attempt > 0:
+            telemetry.retry("scraper")
+        # Back off only if this domain failed recently, without holding any download slot
+        if not scrape_gate.wait(domain, give_up_at):
+            return None
+        with backend_slot("scraper"), scrape_gate.slot(domain):
+            # The slot may have come free only after the batch moved on
+            if give_up_at is not None and time.monotonic() >= give_up_at:
+                return None
+            with telemetry.call("scraper") as call:
+                try: download(article)
+                except Exception as e: article.download_exception_msg = str(e)
+                call.ok = article.download_state == ArticleDownloadState.SUCCESS
+        if article.download_state == ArticleDownloadState.SUCCESS:
+            scrape_gate.succeeded(domain)
+            break
+        scrape_gate.failed(domain)
+    else:
+        pwarn(f"Tool learning Warning: scraper failed on {url}. {article.download_exception_msg}")
+        telemetry.failure("scraper")
+        return {"status": "failed", "publish_date": None, "text": "", "fetched_at": time.time()}
     try: article.parse()
     except Exception as e:
         pwarn(f"Tool learning Warning: scraper failed on {url}. {e}")
+        telemetry.failure("scraper")
+        return {"status": "failed", "publish_date": None, "text": "", "fetched_at": time.time()}
+    publish_date = str(article.publish_date) if article.publish_date is not None else None
+    return {"status": "ok", "publish_date": publish_date, "text": article.text, "fetched_at": time.time()}
+
+
+def cached_fetch_article(url, give_up_at=None):
+    if article_cache is not None:
+        entry = article_cache.get(url)
+        if entry is not None:
+            ttl = article_cache_ttl["ok"] if entry["status"] == "ok" else article_cache_ttl["failed"]
+            if time.time() - entry["fetched_at"] < ttl:
+                telemetry.cache_hit("scraper")
+                return entry
+    entry = fetch_article(url, give_up_at)
+    # A fetch given up for lack of time says nothing about the page
+    if article_cache is not None and entry is not None:
+        article_cache.put(url, entry)
+    return entry
+
+
+@traced()
+def scraper(url, max_len=2000, give_up_at=None):
+    if url == None or url == "" or "http" not in url:
+        return ""
+    entry = cached_fetch_article(url, give_up_at)
+    if entry is None or entry["status"] != "ok":
         return ""
 
-    publish_date=article.publish_date
-    text=article.text
+    publish_date=entry["publish_date"]
+    text=entry["text"]
     body_text = f"publish date: {publish_date}\n\n{text}"
     body_text = body_text[:max_len]
     return body_text
+
+
+def scrape_batch(urls, max_len=2000, deadline=None):
+    # Scrape all urls concurrently; urls not done by the deadline come back as ""
+    if deadline is None:
+        deadline = scraper_policy["batch_deadline"]
+    give_up_at = time.monotonic() + deadline
+    futures = [scrape_executor.submit(scraper, url, max_len, give_up_at) for url in urls]
+    wait(futures, timeout=deadline)
+    texts = []
+    for future in futures:
+        if future.done() and future.exception() is None:
+            texts.append(future.result())
+        else:
+            # Only drops urls still queued; running ones stop before their next attempt
+            future.cancel()
+            texts.append("")
+    return texts
     
 
 
-def text_search(query, query_type="title", top_k=5):
+class ThrottledSearch:
+    """DuckDuckGo sessions shared by all threads, starting requests at least `interval` seconds apart.
+
+    One DDGS session is kept per allowed concurrent search, so no session is used by two threads at once.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+        self.sessions = queue.LifoQueue()
+
+    def text(self, query, **kwargs):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            with span('ddgs_throttle'):
+                sleep(delay)
+        with backend_slot("search"):
+            try: session = self.sessions.get_nowait()
+            except queue.Empty: session = DDGS()
+            try:
+                with telemetry.call("ddgs"), span('ddgs'):
+                    # The region is left out of the cassette key, so recordings survive changes to region detection
+                    return cassette.call("ddgs", dict(query=query, max_results=kwargs.get("max_results")),
+                                         lambda: list(session.text(query, **kwargs)))
+            finally:
+                self.sessions.put(session)
+
+
+search_session = ThrottledSearch(search_policy["interval"])
+search_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")
+
+
+@traced()
+def text_search(query, query_type="title", top_k=5, region=None):
     # Prefix
-    region = predict_region(query)
+    region = region or region_detector.region(query)
+    key = cache_key(query=query, region=region, query_type=query_type, top_k=top_k)
     prefix = 'fake news '
     if query_type =='title':
         query = prefix + query
 
     # DuckDuckGo Search
-    max_results = 2*top_k
-    # with DDGS() as ddgs:
-    try:
-        results=list(DDGS().text(query, 
-                            region=region, 
-                            safesearch='off', 
-                            max_results=max_results))
-    except DuckDuckGoSearchException as e:
-        pwarn(f"Tool learning Warning: DuckDuckGo search failed on {query}. {e}")
-        return []
+    results = None
+    if search_cache is not None:
+        entry = search_cache.get(key)
+        if entry is not None and time.time() - entry["fetched_at"] < search_policy["cache_ttl"]:
+            results = entry["results"]
+            telemetry.cache_hit("ddgs")
+    if results is None:
+        max_results = 2*top_k
+        try:
+            results=search_session.text(query, 
+                                        region=region, 
+                                        safesearch='off', 
+                                        max_results=max_results)
+        except (DuckDuckGoSearchException, ReplayedError, CassetteMiss) as e:
+            pwarn(f"Tool learning Warning: DuckDuckGo search failed on {query}. {e}")
+            telemetry.failure("ddgs")
+            return []
+        # The raw results are cached, so changes to the source filter still apply to cached queries
+        if search_cache is not None:
+            search_cache.put(key, {"results": results, "fetched_at": time.time()})
     if not results: 
         return []
 
@@ -156,14 +399,16 @@ def text_search(query, query_type="title", top_k=5):
 
 
 
-def evidence_extraction(search_results, query, pre_max_len=2000, after_max_len=250, max_items = 3):
+@traced()
+def evidence_extraction(search_results, query, pre_max_len=2000, after_max_len=None, max_items = 3):
     documents = {}
     headers = {}
+    full_texts = scrape_batch([search_result['href'] for search_result in search_results], pre_max_len)
     for id, search_result in enumerate(search_results):
         title = search_result['title']
-        link = search_result['href']
         body = search_result["body"]
-        full_text = scraper(link,pre_max_len)
+        full_text = full_texts[id]
+        # Fall back to the search snippet for failed, empty or late pages
         if len(full_text)<30:
             documents[str(id)] = body
         else:  
@@ -172,138 +417,196 @@ def evidence_extraction(search_results, query, pre_max_len=2000, after_max_len=2
         headers[str(id)] = f"Title: {title}."
 
     # Prompt formation
-    with open(prompts_root+'evidence_extraction.md', 'r', encoding='utf-8') as f: 
-        prompt=f.read()
-    prompt=prompt.format(EVIDENCE = json.dumps(documents), TEXT = query)
+    prompt=evidence_extraction_prompt.format(EVIDENCE = json.dumps(documents), TEXT = query)
     
     # GPT Query
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.1
-    )
-    response = completion.choices[0].message.content
+    response = get_transport().chat(text_messages(prompt, evidence_extraction_system), model="gpt-3.5-turbo",
+                                    max_tokens=None, temperature=0.1, stage="evidence_extraction",
+                                    response_format=json_mode("gpt-3.5-turbo", evidence_extraction_system + prompt))
 
     evidences = []
     try:
-        extracted_results=json.loads(response)
+        extracted_results, repaired = repair_json(response)
+        if repaired: telemetry.count("evidence_extraction", "repairs")
         for id, extracted_result in extracted_results.items():
             if extracted_result != "":
                 evidence = headers[str(id)] + extracted_result 
                 evidences.append(evidence)
     except:
         pwarn("Tool learning Warning: Invalid response from evidence_extraction. Remain unchanged.")
+        telemetry.failure("evidence_extraction")
         evidences = list(documents.values())
+    # Cut to after_max_len characters if given; get_evidence packs by tokens instead
     evidences=[evidence[:after_max_len] for evidence in evidences if len(evidence)>0]
     return evidences[:max_items]
     
 
+@traced()
 def get_evidence(text, title, questions, max_len=2000):
     # Query processing
     top_k=5
     query_set = [title] + questions
     get_query_type = ['title'] + ['question']*len(questions)
     all_search_results = {}
-    titles_seen = set()
-    for qid, query in enumerate(query_set): 
-        # Query Type
-        q_type=get_query_type[qid]
-        # Text Search
-        results=text_search(query, q_type, top_k)
-
-        # Results Formatting
-        for result in results:
-            if result['title'] in titles_seen: continue
-            else: titles_seen.add(result['title'])
-            try:
-                all_search_results[query].append(result)
-            except:
-                all_search_results[query]=[result]
+    # Text Search, all queries at once
+    regions = region_detector.regions(query_set)
+    all_results = list(search_executor.map(text_search, query_set, get_query_type, [top_k]*len(query_set), regions))
+
+    # Results Formatting: one result per cluster of near-duplicates across all queries
+    flattened = [(query, result) for query, results in zip(query_set, all_results) for result in results]
+    clusters = NearDuplicates(**near_duplicate_policy).representatives(
+        [(result['title'], result['body'], result['href']) for _, result in flattened])
+    for i, (query, result) in enumerate(flattened):
+        if clusters[i] == i:
+            all_search_results.setdefault(query, []).append(result)
 
     # logging
-    search_log = {"original_post":text, "title":title, "questions":questions, "original_search_results":all_search_results}
+    search_log = {"original_post":text, "title":title, "questions":questions, "original_search_results":all_search_results,
+                  "duplicates": duplicate_report([result for _, result in flattened], clusters)}
 
     # Topic Relevance Filter
     enhanced_text =f"Title: {title}. \n {text}"
-    all_search_results = topic_relevance_filter(enhanced_text, all_search_results, top_k, query_set)
+    all_search_results = topic_relevance_filter(enhanced_text, all_search_results, top_k, query_set, log=search_log)
     search_log["relevant_search_results"]=all_search_results
     # Evidence Extraction
     all_search_results[title]=evidence_extraction(all_search_results[title], enhanced_text)
 
-    # Formatting
-    retrieved_dict = {f"Infomation might relate to '{title}'":json.dumps(all_search_results[title])}
-    all_search_results.pop(title,None)
+    # Formatting: the snippets most relevant to the post, within the token budget of the refine prompt
+    groups = [(title, all_search_results.pop(title, None) or [])]
+    # What the refine prompt got before packing: the extracted evidence and two results per question, as JSON
+    unpacked = {f"Infomation might relate to '{title}'": json.dumps(groups[0][1])}
     for question, evidences in all_search_results.items():
-        info_list = [] 
-        for evidence in evidences[:2]:
-            # Source: {urlparse(evidence['href']).hostname}
-            info_list.append(f"Title: {evidence['title']}.\n {evidence['body']}")
-        retrieved_dict[f"Infomation might relate to '{question}'"] = info_list
+        # Source: {urlparse(evidence['href']).hostname}
+        groups.append((question, [f"Title: {evidence['title']}. {evidence['body']}" for evidence in evidences]))
+        unpacked[f"Infomation might relate to '{question}'"] = [f"Title: {evidence['title']}.\n {evidence['body']}" for evidence in evidences[:2]]
+    retrieved_text, report = packed_evidence("get_evidence", enhanced_text, groups, evidence_budget["text"],
+                                             "Infomation might relate to '{}':", json.dumps(unpacked))
 
     # logging
-    search_log["retrieved_text"] = retrieved_dict
-    with open(out_root + "search_results.jsonl", 'a', encoding='utf-8') as f: 
+    search_log["retrieved_text"] = retrieved_text
+    search_log["packing"] = report
+    with search_log_lock, open(search_log_path, 'a', encoding='utf-8') as f: 
         f.write(json.dumps(search_log, ensure_ascii=False, indent=4))
-    return json.dumps(retrieved_dict)
+    return retrieved_text
+
 
-def human_verification():
-    global driver, is_first_call
-    is_first_call = False
+def duplicate_report(results, clusters):
+    # Collapsed results of get_evidence and the tokens they would have cost downstream
+    dropped = [result for i, result in enumerate(results) if clusters[i] != i]
+    saved = sum(count_tokens(f"{result['title']} {result['body']}") for result in dropped)
+    telemetry.count("near_duplicates", "duplicates", len(dropped))
+    telemetry.count("near_duplicates", "evidence_saved", saved)
+    print("Near-duplicate results: {} of {} collapsed ({:.0%}), {} tokens saved".format(
+        len(dropped), len(results), len(dropped) / len(results) if results else 0.0, saved))
+    return {"results": len(results), "collapsed": len(dropped), "ratio": len(dropped) / len(results) if results else 0.0,
+            "saved_tokens": saved,
+            "clusters": [[results[clusters[i]]['href'], result['href']] for i, result in enumerate(results) if clusters[i] != i]}
+
+
+def packed_evidence(stage, query, groups, budget, header, unpacked):
+    # pack() with the tokens saved against `unpacked`, the text the refine prompt got before packing
+    text, report = pack(query, groups, budget, header)
+    # Without evidence nothing was packed, and nothing saved
+    report["saved_tokens"] = max(0, count_tokens(unpacked) - report["tokens"]) if report["snippets"] else 0
+    telemetry.count(stage, "evidence_tokens", report["tokens"])
+    telemetry.count(stage, "evidence_saved", report["saved_tokens"])
+    print("Evidence packing ({}): {} of {} tokens, {} saved, {}/{} snippets kept, {} repeated sentences dropped".format(
+        stage, report["tokens"], budget, report["saved_tokens"], report["kept"], report["snippets"],
+        report["duplicate_sentences"]))
+    return text, report
+
+@traced()
+def human_verification(driver, timeout=300):
     # Google Image Search Page
-    try:
-        driver.get('https://www.google.com/search?q=chrome')
-    except:
-        try: driver.quit()
-        except: pass
-        driver = webdriver.Chrome(options=options)
-        driver.get('https://www.google.com/search?q=chrome')
+    driver.get('https://www.google.com/search?q=chrome')
+    def verified(driver):
+        return not driver.current_url.startswith('https://www.google.com/sorry/')
+    if verified(driver):
+        return
+    if timeout <= 0:
+        raise TimeoutError("Google asks for human verification, which cannot be completed in a headless browser.")
 
     # You should manually complete the reCAPTCHA human verification on the browser
     # After you complete it, the program will automatically resume
-    five_minutes = 300
-    for i in range(five_minutes):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
         # Remind the user to complete the reCAPTCHA every 30 seconds
-        if i%30==0:
-            print("\n\nACTION REQUIRED!!!\nPlease complete the reCAPTCHA human verification on the browser in 5 minutes. After you complete it, the program will automatically resume......\n")
-        # Check if the verfication is successful
-        current_url = driver.current_url 
-        if not current_url.startswith('https://www.google.com/sorry/'):
+        print("\n\nACTION REQUIRED!!!\nPlease complete the reCAPTCHA human verification on the browser in 5 minutes. After you complete it, the program will automatically resume......\n")
+        try:
+            WebDriverWait(driver, min(30, deadline - time.monotonic()), poll_frequency=0.25).until(verified)
             print("\n\nProgram resumed......\n")
             return
-        sleep(1)  
+        except TimeoutException:
+            continue
     raise TimeoutError("Human verification is not completed in 5 minutes. Program terminated. Please try again.")
 
     
 
+@traced()
 def visual_search(source, original_post, is_url=True, max_items = 5):
-    global driver, is_first_call
-    if is_first_call:
-        human_verification()
-    # Google Image Search Page
+    # Posts sharing an image share one lookup, also when they are searched at the same time;
+    # the page titles found are then packed by their relevance to this post
+    key = cache_key(image=image_digest(source), is_url=is_url, max_items=max_items, found="results")
+    search_results = visual_search_flight.do(key, lambda: cached_visual_search(key, source, original_post, is_url, max_items))
+    # The raw results are cached, so changes to the source filter still apply to cached lookups
+    titles = []
+    for search_result in source_filter(search_results):
+        title = search_result['title']
+        if title !="":
+            # "source":urlparse(link).hostname
+            titles.append("Title: " + title.replace("来源","Source"))
+    titles = titles[:max_items]
+    if not titles:
+        return "Nothing found"
+    retrieved_text, _ = packed_evidence("visual_search", original_post, [("Image occurs in", titles)],
+                                        evidence_budget["visual"], "{}:",
+                                        "Image occurs in: " + json.dumps(titles, ensure_ascii=False))
+    return retrieved_text
+
+
+def cached_visual_search(key, source, original_post, is_url=True, max_items = 5):
+    if visual_search_cache is not None:
+        cached = visual_search_cache.get(key)
+        if cached is not None:
+            telemetry.cache_hit("visual_search")
+            return cached
     try:
+        search_results = cassette.call("visual_search", dict(key=key),
+                                       lambda: driver_visual_search(source, original_post, is_url, max_items))
+    except Exception:
+        telemetry.failure("visual_search")
+        raise
+    if visual_search_cache is not None:
+        visual_search_cache.put(key, search_results)
+    return search_results
+
+
+def driver_visual_search(source, original_post, is_url=True, max_items = 5):
+    # Each driver serves one lookup at a time; a driver whose browser fails is dropped from the pool
+    with get_driver_pool().driver() as driver, telemetry.call("visual_search"):
+        return _visual_search(driver, source, original_post, is_url, max_items)
+
+
+def _visual_search(driver, source, original_post, is_url=True, max_items = 5):
+    deadlines = visual_search_deadlines
+    # Google Image Search Page
+    with span('page_load', page='imghp'):
         driver.get('https://www.google.com/imghp')
-    except:
-        try: driver.quit()
-        except: pass
-        driver = webdriver.Chrome(options=options)
-        driver.get('https://www.google.com/imghp')
-    sleep(1)  
-    button = driver.find_element(By.CSS_SELECTOR, "div.nDcEnd")
+    button = wait_for(driver, "lens_button", EC.element_to_be_clickable((By.CSS_SELECTOR, "div.nDcEnd")), deadlines["lens_button"])
     button.click()
-    sleep(1) 
 
     # Get the image
     if is_url:
         # use the image url
         if "http" not in source: 
             source=imgbed_root+source
-        driver.find_element(By.CSS_SELECTOR, "input.cB9M7").send_keys(source)
-        search_button=driver.find_element(By.CSS_SELECTOR, "div.Qwbd3")
+        upload_box = wait_for(driver, "upload_box", EC.element_to_be_clickable((By.CSS_SELECTOR, "input.cB9M7")), deadlines["upload_box"])
+        upload_box.send_keys(source)
+        search_button = wait_for(driver, "search_button", EC.element_to_be_clickable((By.CSS_SELECTOR, "div.Qwbd3")), deadlines["search_button"])
         search_button.click()       
     else:
         # upload the image
+        import pyautogui    # needs a display, so only imported for local uploads
         image_path=os.path.abspath(source) 
         pyautogui.typewrite(image_path)
         sleep(3)  
@@ -313,17 +616,21 @@ def visual_search(source, original_post, is_url=True, max_items = 5):
         driver.find_element_by_name('file').send_keys(r"D:\test\xuexi\test\14.png")
         upload_button = driver.find_element(By.CSS_SELECTOR, "div.ZeVBtc>span")
         upload_button.click()
-    sleep(2)
 
     # image_serach result page
-    # We locate this block by the text "Exact matches". Do not worry that you are using another language for your PC, or Chrome. We set the language used by the driver to English in the begining of this script: options.add_argument("--lang=en")
-    list_div = driver.find_elements(By.XPATH, "//a[.//*[contains(text(), 'Exact matches')]]")
-    exact_search_page_url = list_div[0].get_attribute('href')
+    # We locate this block by the text "Exact matches". Do not worry that you are using another language for your PC, or Chrome. The DriverPool sets the language used by the driver to English: options.add_argument("--lang=en")
+    wait_for(driver, "lens_results", lambda d: "imghp" not in d.current_url and d.execute_script("return document.readyState") == "complete", deadlines["lens_results"])
+    try:
+        exact_matches = wait_for(driver, "exact_matches", EC.presence_of_element_located((By.XPATH, "//a[.//*[contains(text(), 'Exact matches')]]")), deadlines["exact_matches"])
+    except StepTimeout:
+        # No exact matches for this image: an answer like any other, cached and shared as "Nothing found"
+        return []
+    exact_search_page_url = exact_matches.get_attribute('href')
 
     # exact_search result page
-    driver.get(exact_search_page_url)
-    sleep(2)
-    search_div = driver.find_element(By.CSS_SELECTOR, "div#search")  
+    with span('page_load', page='exact_matches'):
+        driver.get(exact_search_page_url)
+    search_div = wait_for(driver, "results", EC.presence_of_element_located((By.CSS_SELECTOR, "div#search")), deadlines["results"])
     results = search_div.find_elements(By.TAG_NAME, "a")
     
     search_results=[]
@@ -333,22 +640,11 @@ def visual_search(source, original_post, is_url=True, max_items = 5):
             continue
         title = result.text
         search_results.append({"title":title, "href":link})
-    search_results = source_filter(search_results)
-    return_list = []
-    for search_result in search_results:
-        title = search_result['title']
-        if title !="":
-            # "source":urlparse(link).hostname
-            return_list.append("Title: " + title.replace("来源","Source"))
-    if return_list==[]:
-        driver.quit()
-        return "Nothing found"
-    retrieved_text = "Image occurs in: " + json.dumps(return_list[:max_items],ensure_ascii=False)
-    return retrieved_text
+    return search_results
 
 def driver_quit():
-    global driver
-    driver.quit()
+    if driver_pool is not None:
+        driver_pool.close()
 
 
 # Unit test: 
@@ -0,0 +1,149 @@
+import os
+import json
+import glob
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from result_log import ResultLog
+from llm_transport import get_transport
+from telemetry import telemetry
+from tracing import span
+from pipeline import needs_external, fused_decision
+from utils import pwarn
+
+
+class StageRunner:
+    """Runs the LEMMA pipeline stage by stage over the whole dataset instead of item by item.
+
+    Direct runs over every item, then external_knowledge (unless fused into Direct), then question_gen and retrieval for the
+    items that need external knowledge, then refine. Each stage appends {index, output} lines to
+    <stage_dir>/<stage>.jsonl as items finish, so a resumed run skips whatever a stage already did.
+    With `batch_api`, each model stage is sent as one OpenAI batch job (a JSONL request file) and
+    only the requests the batch could not answer are retried through the normal API.
+    """
+    def __init__(self, pipeline, stage_dir, workers=1, batch_api=False, poll_interval=30, resume=False):
+        self.pipeline = pipeline
+        self.stage_dir = stage_dir
+        self.workers = max(1, workers)
+        self.batch_api = batch_api
+        self.poll_interval = poll_interval
+        if not os.path.exists(stage_dir):
+            os.makedirs(stage_dir)
+        if not resume:
+            for path in glob.glob(os.path.join(stage_dir, '*.json*')):
+                os.remove(path)
+
+    def stage_path(self, stage, suffix='.jsonl'):
+        return os.path.join(self.stage_dir, stage + suffix)
+
+    def run_stage(self, stage, jobs, fn):
+        # jobs: index -> arguments of fn; returns index -> output for every job
+        outputs = ResultLog.read(self.stage_path(stage))
+        pending = [index for index in jobs if index not in outputs]
+        print('Stage {}: {} items, {} already done'.format(stage, len(jobs), len(jobs) - len(pending)))
+        log = ResultLog(self.stage_path(stage), resume=True)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor, span('stage ' + stage, items=len(pending)):
+                futures = {executor.submit(self.run_job, stage, index, fn, jobs[index]): index for index in pending}
+                for future in as_completed(futures):
+                    log.append(futures[future], future.result())
+                    outputs[futures[future]] = future.result()
+        finally:
+            log.close()
+        return {index: outputs[index] for index in jobs}
+
+    def run_job(self, stage, index, fn, job):
+        with span(stage, index=index):
+            return fn(job)
+
+    def run_component_stage(self, stage, component, inputs):
+        # inputs: index -> keyword arguments of the component
+        if self.batch_api:
+            self.run_batch(stage, component, inputs)
+        return self.run_stage(stage, inputs, lambda kwargs: component(**kwargs))
+
+    def run_batch(self, stage, component, inputs):
+        done = ResultLog.read(self.stage_path(stage))
+        prepared = {index: component.prepare(**kwargs) for index, kwargs in inputs.items() if index not in done}
+        log = ResultLog(self.stage_path(stage), resume=True)
+        try:
+            # Cached answers need no request
+            for index, (prompt, image_path) in list(prepared.items()):
+                cached = component.lookup(prompt, image_path)
+                if cached is not None:
+                    telemetry.cache_hit(component.name)
+                    log.append(index, cached)
+                    del prepared[index]
+            if not prepared:
+                return
+
+            # The batch id is kept on disk so a resumed run collects the job instead of resubmitting it
+            state_path = self.stage_path(stage, '.batch.json')
+            if os.path.exists(state_path):
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    batch_id = json.load(f)['batch_id']
+            else:
+                requests_path = self.stage_path(stage, '.requests.jsonl')
+                with open(requests_path, 'w', encoding='utf-8') as f:
+                    for index, (prompt, image_path) in prepared.items():
+                        model, messages = component.request(prompt, image_path)
+                        body = {'model': model, 'messages': messages, 'max_tokens': component.max_tokens,
+                                'temperature': component.temperature}
+                        response_format = component.response_format(model, prompt)
+                        if response_format is not None:
+                            body['response_format'] = response_format
+                        f.write(json.dumps({'custom_id': str(index), 'method': 'POST', 'url': '/v1/chat/completions',
+                                            'body': body}, ensure_ascii=False) + '\n')
+                batch_id = get_transport().submit_batch(requests_path)
+                with open(state_path, 'w', encoding='utf-8') as f:
+                    json.dump({'batch_id': batch_id, 'requests': len(prepared)}, f)
+            print('Stage {}: waiting for batch {} ({} requests)'.format(stage, batch_id, len(prepared)))
+
+            contents = get_transport().collect_batch(batch_id, self.poll_interval, stage=component.name)
+            for index, (prompt, image_path) in prepared.items():
+                if str(index) not in contents: continue
+                try:
+                    result = component.parse(contents[str(index)])
+                except Exception as e:
+                    pwarn(f'Stage {stage}: unusable batch answer for index {index}, {e}')
+                    telemetry.retry(component.name)
+                    continue
+                component.store(prompt, image_path, result)
+                log.append(index, result)
+            os.remove(state_path)
+        finally:
+            log.close()
+
+    def run(self, data, indices):
+        # -> index -> log record (None where a component gave up), for the given dataset indices
+        pipeline = self.pipeline
+        records = {}
+
+        direct = self.run_component_stage('direct_fused' if pipeline.fused_direct else 'direct', pipeline.first_module,
+                                          {i: pipeline.direct_inputs(data[i]) for i in indices})
+        indices = [i for i in indices if direct[i] is not None]
+
+        if pipeline.fused_direct:
+            decisions = {i: fused_decision(direct[i]) for i in indices}
+        else:
+            decisions = self.run_component_stage('external_knowledge', pipeline.external_knowledge_module,
+                                                 {i: pipeline.external_inputs(data[i], direct[i]) for i in indices})
+        indices = [i for i in indices if decisions[i] is not None]
+        retrieval_indices = []
+        for i in indices:
+            if needs_external(decisions[i]):
+                retrieval_indices.append(i)
+            else:
+                records[i] = pipeline.record(data[i], direct[i])
+
+        questions = self.run_component_stage('question_gen', pipeline.question_gen_module,
+                                             {i: pipeline.question_inputs(data[i], direct[i]) for i in retrieval_indices})
+        retrieval_indices = [i for i in retrieval_indices if questions[i] is not None]
+
+        retrievals = self.run_stage('retrieval', {i: (data[i], questions[i]) for i in retrieval_indices},
+                                    lambda args: pipeline.retrieve(*args))
+
+        refined = self.run_component_stage('refine', pipeline.refine_prediction_module,
+                                           {i: pipeline.refine_inputs(data[i], direct[i], retrievals[i]) for i in retrieval_indices})
+        for i in retrieval_indices:
+            if refined[i] is not None:
+                records[i] = pipeline.record(data[i], direct[i], refined[i], retrievals[i])
+        return records
@@ -0,0 +1,104 @@
+import re
+import ast
+import json
+from configs import json_mode_models
+
+
+def strip_fences(text):
+    # Content of the outermost ``` or ```json fence, if any
+    match = re.search(r"```(?:json)?(.*)```", text, flags=re.DOTALL)
+    return (match.group(1) if match else text).strip()
+
+
+def extract_json_text(text):
+    # Drop prose around the outermost object or array; keep an unterminated one as it is
+    text = strip_fences(text)
+    starts = [i for i in (text.find('{'), text.find('[')) if i != -1]
+    if not starts:
+        return text
+    start = min(starts)
+    end = max(text.rfind('}'), text.rfind(']'))
+    return text[start:end + 1] if end > start else text[start:]
+
+
+def remove_trailing_commas(text):
+    return re.sub(r",\s*([}\]])", r"\1", text)
+
+
+def close_truncated(text):
+    # Terminate an open string and close every open bracket of a cut-off answer
+    stack = []
+    quote = None
+    escaped = False
+    for char in text:
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]' and stack:
+            stack.pop()
+    if quote is not None:
+        text += quote
+    text = text.rstrip()
+    if text.endswith(':'):
+        text += ' null'
+    text = text.rstrip(',')
+    return text + ''.join(reversed(stack))
+
+
+def python_literal(text):
+    # Single-quoted, Python-style answers, possibly with JSON's true/false/null
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        text = re.sub(r"\btrue\b", "True", re.sub(r"\bfalse\b", "False", re.sub(r"\bnull\b", "None", text)))
+        return ast.literal_eval(text)
+
+
+def repair_json(text):
+    """Parse a model answer that should be JSON -> (value, whether it needed repair).
+
+    Tries the answer as it is, then without code fences and surrounding prose, without trailing
+    commas, as a single-quoted Python literal and with a cut-off end closed. Raises ValueError if
+    nothing parses.
+    """
+    try:
+        return json.loads(text), False
+    except (TypeError, ValueError):
+        pass
+    candidate = remove_trailing_commas(extract_json_text(text))
+    closed = close_truncated(candidate)
+    attempts = [(json.loads, candidate), (python_literal, candidate), (json.loads, closed), (python_literal, closed)]
+    for parse, attempt in attempts:
+        try:
+            return parse(attempt), True
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            continue
+    raise ValueError(f"unparseable JSON answer: {text[:200]!r}")
+
+
+def validate(value, schema):
+    # schema: {key: type} of the keys a JSON object answer must have
+    if not isinstance(value, dict):
+        raise ValueError(f"expected a JSON object, got {type(value).__name__}")
+    for key, kind in schema.items():
+        if key not in value:
+            raise ValueError(f"missing key '{key}'")
+        if not isinstance(value[key], kind):
+            raise ValueError(f"key '{key}' should be {kind.__name__}, got {type(value[key]).__name__}")
+    return value
+
+
+def json_mode(model, prompt):
+    # response_format for a model answering with a JSON object, if the model supports JSON mode;
+    # the API rejects JSON mode unless the prompt itself mentions JSON
+    if model in json_mode_models and 'json' in prompt.lower():
+        return {"type": "json_object"}
+    return None
@@ -0,0 +1,185 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from configs import telemetry_policy
+
+
+class CallRecord:
+    """Filled in by the caller inside `Telemetry.call`; an exception or ok = False counts as an error."""
+    def __init__(self):
+        self.ok = True
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+
+class StageStats:
+    counters = ('calls', 'errors', 'retries', 'failures', 'cache_hits', 'repairs', 'prompt_tokens', 'completion_tokens',
+                'cached_tokens', 'evidence_tokens', 'evidence_saved', 'skipped_calls', 'duplicates')
+
+    def __init__(self, buckets):
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.latency_count = 0
+        self.bucket_counts = [0] * len(buckets)
+
+
+class Telemetry:
+    """Per-stage totals of model and external calls: tokens, latency, retries, cache hits and failures.
+
+    A stage is a component name (Direct, question_gen, ...) or an external call (ddgs, scraper,
+    visual_search). `calls` counts requests sent to the backend and `errors` the ones that failed;
+    `failures` counts the times a stage gave up on an input after its retries.
+    """
+    def __init__(self, buckets=None):
+        self.buckets = sorted(buckets or telemetry_policy["latency_buckets"])
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.exporter = None
+        self.stop_export = threading.Event()
+
+    def stage(self, stage):
+        # Callers hold self.lock
+        if stage not in self.stages:
+            self.stages[stage] = StageStats(self.buckets)
+        return self.stages[stage]
+
+    def record(self, stage, latency=None, ok=True, prompt_tokens=0, completion_tokens=0, cached_tokens=0):
+        # latency=None for calls whose duration is unknown, e.g. batch API answers
+        with self.lock:
+            s = self.stage(stage)
+            s.calls += 1
+            s.errors += 0 if ok else 1
+            s.prompt_tokens += prompt_tokens
+            s.completion_tokens += completion_tokens
+            s.cached_tokens += cached_tokens
+            if latency is not None:
+                s.latency_sum += latency
+                s.latency_max = max(s.latency_max, latency)
+                s.latency_count += 1
+                position = bisect.bisect_left(self.buckets, latency)
+                if position < len(self.buckets):
+                    s.bucket_counts[position] += 1
+
+    def count(self, stage, counter, n=1):
+        with self.lock:
+            s = self.stage(stage)
+            setattr(s, counter, getattr(s, counter) + n)
+
+    def retry(self, stage):
+        self.count(stage, 'retries')
+
+    def failure(self, stage):
+        self.count(stage, 'failures')
+
+    def cache_hit(self, stage):
+        self.count(stage, 'cache_hits')
+
+    @contextmanager
+    def call(self, stage):
+        call = CallRecord()
+        start = time.monotonic()
+        try:
+            yield call
+        except BaseException:
+            call.ok = False
+            raise
+        finally:
+            self.record(stage, time.monotonic() - start, call.ok, call.prompt_tokens, call.completion_tokens,
+                        call.cached_tokens)
+
+    def summary(self):
+        with self.lock:
+            lines = ['{:<24} {:>6} {:>6} {:>7} {:>8} {:>10} {:>7} {:>12} {:>12} {:>12} {:>8} {:>8}'.format(
+                'stage', 'calls', 'errors', 'retries', 'failures', 'cache_hits', 'repairs', 'prompt_tok', 'cached_tok',
+                'complete_tok', 'mean_s', 'max_s')]
+            for stage, s in sorted(self.stages.items()):
+                mean = s.latency_sum / s.latency_count if s.latency_count else 0.0
+                lines.append('{:<24} {:>6} {:>6} {:>7} {:>8} {:>10} {:>7} {:>12} {:>12} {:>12} {:>8.3f} {:>8.3f}'.format(
+                    stage, s.calls, s.errors, s.retries, s.failures, s.cache_hits, s.repairs, s.prompt_tokens,
+                    s.cached_tokens, s.completion_tokens, mean, s.latency_max))
+            for stage, s in sorted(self.stages.items()):
+                if s.duplicates:
+                    lines.append('{}: {} results collapsed, {} evidence tokens saved'.format(
+                        stage, s.duplicates, s.evidence_saved))
+                elif s.evidence_tokens or s.evidence_saved:
+                    lines.append('{}: {} evidence tokens passed on, {} saved by packing'.format(
+                        stage, s.evidence_tokens, s.evidence_saved))
+                if s.skipped_calls:
+                    lines.append('{}: {} model calls skipped by local decisions'.format(stage, s.skipped_calls))
+            return '\n'.join(lines)
+
+    def openmetrics(self):
+        # OpenMetrics text exposition of every stage, readable by Prometheus' textfile collector
+        def label(stage):
+            return 'stage="{}"'.format(stage.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+        families = [
+            ('calls', 'Requests sent to the backend of a stage'),
+            ('errors', 'Requests that raised or returned an unusable answer'),
+            ('retries', 'Requests repeated after an error'),
+            ('failures', 'Inputs a stage gave up on'),
+            ('cache_hits', 'Answers served from a cache'),
+            ('repairs', 'Malformed JSON answers repaired locally instead of re-queried'),
+            ('prompt_tokens', 'Prompt tokens reported by the model API'),
+            ('completion_tokens', 'Completion tokens reported by the model API'),
+            ('cached_tokens', 'Prompt tokens served from the model API prompt cache'),
+            ('evidence_tokens', 'Tokens of retrieved evidence packed into the refine prompt'),
+            ('evidence_saved', 'Tokens of retrieved evidence left out by packing or duplicate collapsing'),
+            ('skipped_calls', 'Model calls made unnecessary by local decisions'),
+            ('duplicates', 'Near-duplicate search results collapsed into another result'),
+        ]
+        with self.lock:
+            lines = []
+            for name, help_text in families:
+                lines.append('# TYPE lemma_{} counter'.format(name))
+                lines.append('# HELP lemma_{} {}.'.format(name, help_text))
+                for stage, s in sorted(self.stages.items()):
+                    lines.append('lemma_{}_total{{{}}} {}'.format(name, label(stage), getattr(s, name)))
+            lines.append('# TYPE lemma_call_latency_seconds histogram')
+            lines.append('# HELP lemma_call_latency_seconds Duration of the requests of a stage.')
+            for stage, s in sorted(self.stages.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, s.bucket_counts):
+                    cumulative += n
+                    lines.append('lemma_call_latency_seconds_bucket{{{},le="{}"}} {}'.format(label(stage), float(bound), cumulative))
+                lines.append('lemma_call_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(label(stage), s.latency_count))
+                lines.append('lemma_call_latency_seconds_sum{{{}}} {}'.format(label(stage), s.latency_sum))
+                lines.append('lemma_call_latency_seconds_count{{{}}} {}'.format(label(stage), s.latency_count))
+            lines.append('# EOF')
+            return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # Written to a temporary file first, so a scraper never reads half a file
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.openmetrics())
+        os.replace(path + '.tmp', path)
+
+    def start_export(self, path, interval=None):
+        # Rewrite `path` every `interval` seconds until stop(), which writes it one last time
+        interval = interval or telemetry_policy["export_interval"]
+        self.stop_export.clear()
+
+        def export():
+            while not self.stop_export.wait(interval):
+                self.write(path)
+
+        self.export_path = path
+        self.exporter = threading.Thread(target=export, name='telemetry-export', daemon=True)
+        self.exporter.start()
+
+    def stop(self):
+        if self.exporter is None:
+            return
+        self.stop_export.set()
+        self.exporter.join()
+        self.exporter = None
+        self.write(self.export_path)
+
+
+# Shared by every component and retrieval backend of the process
+telemetry = Telemetry()
@@ -4,6 +4,7 @@ from lemma_component import LemmaComponent
 from retrieval import get_evidence, visual_search, driver_quit
 from configs import out_root, definition_path
 from utils import save, process_multilines_output, perror
+from result_log import ResultLog
 import traceback
 
 # Config
@@ -11,6 +12,7 @@ resume = True
 using_cache = False
 data_name = 'twitter'
 start_index, end_index = 0, 1000
+shard_index, num_shards = 0, 1      # run every num_shards-th item starting at shard_index; merge.py combines shards
 
 
 # Input file name
@@ -31,10 +33,12 @@ with open(input_file, encoding='utf-8') as f:
 
 
 # Output file names
-output_score = out_root + "lemma_" + data_name + "_score"
-output_result = out_root + "lemma_" + data_name + "_output.json"
-if not os.path.exists(out_root):
-    os.makedirs(out_root)   
+output_dir = out_root if num_shards == 1 else out_root + "shard_{}_of_{}/".format(shard_index, num_shards)
+output_score = output_dir + "lemma_" + data_name + "_score"
+output_result = output_dir + "lemma_" + data_name + "_output.json"
+output_log = output_dir + "lemma_" + data_name + "_output.jsonl"
+if not os.path.exists(output_dir):
+    os.makedirs(output_dir)   
 
 # Resume
 labels = []
@@ -67,6 +71,7 @@ if current_index==-1:
     print('Starting from index 0')
 else:
     print('Resuming from index:', current_index, ', Next index:', current_index + 1)
+result_log = ResultLog(output_log, resume=resume)
 
 
 # LEMMA Components Initialization
@@ -85,7 +90,8 @@ question_gen_module = LemmaComponent(prompt='question_gen.md', name='question_ge
 refine_prediction_module = LemmaComponent(prompt='refined_prediction.md', name='modify_reasoning', 
                                           model='gpt4v',using_cache=False,
                                          online_image=use_online_image, max_retry=3, max_tokens=1000, temperature=0.1,
-                                         post_process=process_multilines_output)
+                                         post_process=process_multilines_output,
+                                         static_fields=dict(DEFINITION=open(definition_path, 'r').read()))
 
 # Test
 for i, item in enumerate(data):
@@ -94,6 +100,8 @@ for i, item in enumerate(data):
         continue
     elif current_index>end_index:
         break
+    if current_index % num_shards != shard_index:
+        continue
     print('Processing index {}/{}'.format(current_index, total_data_size))
 
     # Get input data
@@ -149,7 +157,6 @@ for i, item in enumerate(data):
                                                ORIGINAL_REASONING=direct_explain,
                                                EXTERNAL=retrieved_text,
                                                EXTERNAL_VISUAL=visual_retrieved_text,
-                                               DEFINITION=open(definition_path, 'r').read(),
                                                image=url)
         
         # Result Postprocessing
@@ -194,5 +201,6 @@ for i, item in enumerate(data):
     print('Refined Explain:', final_explain)
 
     save(labels, final_preds, direct_labels, current_index, logger, output_result, output_score)
+    result_log.append(current_index, logger[-1])
     
 driver_quit()
\ No newline at end of file
@@ -0,0 +1,52 @@
+from domain_index import DomainIndex, blocklist_entry
+
+
+def test_plain_and_hosts_lines():
+    assert blocklist_entry('example.com') == 'example.com'
+    assert blocklist_entry('WWW.Example.com.') == 'example.com'
+    assert blocklist_entry('0.0.0.0 ads.example.com') == 'ads.example.com'
+    assert blocklist_entry('0.0.0.0 ads.example.com # tracker') == 'ads.example.com'
+    assert blocklist_entry('127.0.0.1 localhost') is None
+
+
+def test_comments_are_skipped():
+    assert blocklist_entry('# example.com') is None
+    assert blocklist_entry('! Adblock comment') is None
+    assert blocklist_entry('') is None
+
+
+def test_adblock_domain_rules():
+    assert blocklist_entry('||tracker.io^') == 'tracker.io'
+    assert blocklist_entry('||tracker.io^$third-party') == 'tracker.io'
+    assert blocklist_entry('||tracker.io/path^') is None
+
+
+def test_adblock_cosmetic_rules_are_skipped():
+    assert blocklist_entry('example.com##.ad') is None
+    assert blocklist_entry('example.com#@#.ad') is None
+    assert blocklist_entry('example.com#?#div:has(.ad)') is None
+    assert blocklist_entry('##.banner') is None
+
+
+def test_adblock_exception_rules_are_skipped():
+    assert blocklist_entry('@@||good.com^') is None
+
+
+def test_load_skips_cosmetic_and_exception_rules(tmp_path):
+    path = tmp_path / 'list.txt'
+    path.write_text('||bad.com^\nexample.com##.ad\n@@||good.com^\n0.0.0.0 ads.net # ads\n', encoding='utf-8')
+    index = DomainIndex()
+    assert index.load(str(path)) == 2
+    assert index.match('www.bad.com') == 'bad.com'
+    assert index.match('ads.net') == 'ads.net'
+    assert index.match('example.com') is None
+    assert index.match('good.com') is None
+
+
+def test_filter_matches_subdomains_in_one_pass():
+    index = DomainIndex({'www.reddit.com', 'm.ixigua.com'})
+    results = [{'href': 'https://old.reddit.com/r'}, {'href': 'https://reddit.com/x'}, {'href': 'https://bbc.com'},
+               {'href': 'https://www.ixigua.com/v'}, {'href': 'http://[bad'}]
+    kept = index.filter(results)
+    assert [r['href'] for r in kept] == ['https://bbc.com', 'https://www.ixigua.com/v', 'http://[bad']
+    assert index.blocked['reddit.com'] == 2
@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("openai")
+from openai.types import CompletionUsage
+from llm_transport import usage_dict
+
+
+def test_usage_dict_reads_cached_tokens_from_plain_dict():
+    # openai==1.33.0 keeps the unmodelled prompt_tokens_details as a dict
+    usage = CompletionUsage(prompt_tokens=2000, completion_tokens=50, total_tokens=2050,
+                            prompt_tokens_details={"cached_tokens": 1920})
+    assert usage_dict(usage) == {"prompt_tokens": 2000, "completion_tokens": 50, "cached_tokens": 1920}
+
+
+def test_usage_dict_reads_cached_tokens_from_attribute():
+    class Details:
+        cached_tokens = 1024
+
+    usage = CompletionUsage(prompt_tokens=1500, completion_tokens=10, total_tokens=1510)
+    usage.prompt_tokens_details = Details()
+    assert usage_dict(usage)["cached_tokens"] == 1024
+
+
+def test_usage_dict_without_details():
+    usage = CompletionUsage(prompt_tokens=100, completion_tokens=10, total_tokens=110)
+    assert usage_dict(usage)["cached_tokens"] == 0
+
+
+def test_chat_reports_cached_tokens_in_telemetry(monkeypatch):
+    from openai.types.chat import ChatCompletion
+    from llm_transport import OpenAITransport
+    from telemetry import telemetry
+
+    class Raw:
+        headers = {}
+
+        def parse(self):
+            return ChatCompletion.construct(
+                choices=[{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "real"}}],
+                usage=CompletionUsage(prompt_tokens=2000, completion_tokens=5, total_tokens=2005,
+                                      prompt_tokens_details={"cached_tokens": 1920}))
+
+    transport = OpenAITransport(api_key="test")
+    monkeypatch.setattr(transport, "_create",
+                        lambda limiter, estimated, **request: transport._finish(limiter, estimated, Raw()))
+    content = transport.chat([{"role": "user", "content": "post"}], model="gpt-4o", stage="cached_tokens_test")
+    assert content == "real"
+    assert telemetry.stages["cached_tokens_test"].cached_tokens == 1920
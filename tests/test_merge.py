@@ -0,0 +1,51 @@
+import os
+import sys
+import subprocess
+import pytest
+
+pytest.importorskip("openai")
+from result_log import ResultLog
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_shards(tmp_path, log_name, num_shards=2, items=6):
+    shard_dirs = []
+    for shard_index in range(num_shards):
+        shard_dir = tmp_path / 'shard_{}_of_{}'.format(shard_index, num_shards)
+        shard_dir.mkdir()
+        log = ResultLog(str(shard_dir / log_name))
+        for index in range(shard_index, items, num_shards):
+            log.append(index, {'label': index % 2, 'direct': 0, 'prediction': index % 2})
+        log.close()
+        shard_dirs.append(str(shard_dir))
+    return shard_dirs
+
+
+def merge(*argv):
+    return subprocess.run([sys.executable, os.path.join(root, 'merge.py')] + list(argv), cwd=root,
+                          capture_output=True, text=True)
+
+
+def test_merges_test_py_shards(tmp_path):
+    shard_dirs = write_shards(tmp_path, 'lemma_twitter_output.jsonl')
+    output_dir = str(tmp_path / 'merged')
+    result = merge(*shard_dirs, '--output_dir', output_dir)
+    assert result.returncode == 0, result.stderr
+    assert sorted(ResultLog.read(os.path.join(output_dir, 'lemma_twitter_output.jsonl'))) == list(range(6))
+    assert os.path.exists(os.path.join(output_dir, 'lemma_twitter_output.json'))
+    assert os.path.exists(os.path.join(output_dir, 'lemma_twitter_score'))
+
+
+def test_shard_without_log_fails(tmp_path):
+    shard_dirs = write_shards(tmp_path, 'lemma_twitter_output.jsonl')
+    os.remove(os.path.join(shard_dirs[1], 'lemma_twitter_output.jsonl'))
+    result = merge(*shard_dirs, '--output_dir', str(tmp_path / 'merged'))
+    assert result.returncode != 0
+    assert 'not found in' in result.stderr
+
+
+def test_log_name_must_exist(tmp_path):
+    shard_dirs = write_shards(tmp_path, 'lemma_twitter_output.jsonl')
+    result = merge(*shard_dirs, '--log_name', 'lemma_output.jsonl', '--output_dir', str(tmp_path / 'merged'))
+    assert result.returncode != 0
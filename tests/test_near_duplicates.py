@@ -0,0 +1,31 @@
+from near_duplicates import NearDuplicates, normalize_url
+
+
+def test_normalize_url_keeps_page_selecting_query():
+    assert normalize_url('https://www.youtube.com/watch?v=A') != normalize_url('https://youtube.com/watch?v=B')
+    assert normalize_url('https://site.com/article?id=1') != normalize_url('https://site.com/article?id=2')
+
+
+def test_normalize_url_drops_tracking_parameters():
+    assert normalize_url('https://www.bbc.com/news/a/?utm_source=x&fbclid=y') == normalize_url('http://bbc.com/news/a')
+    assert normalize_url('https://site.com/a?id=1&gclid=z') == normalize_url('https://site.com/a?id=1')
+
+
+def test_query_variants_are_not_collapsed():
+    documents = [('Video one', 'First clip about the flood', 'https://youtube.com/watch?v=A'),
+                 ('Video two', 'Another clip about a concert', 'https://youtube.com/watch?v=B')]
+    assert NearDuplicates().representatives(documents) == [0, 1]
+
+
+def test_empty_results_are_not_collapsed():
+    documents = [('', '', 'https://a.com/1'), ('', '', 'https://b.com/2'), ('', '', 'https://c.com/3')]
+    assert NearDuplicates().representatives(documents) == [0, 1, 2]
+
+
+def test_syndicated_copies_are_collapsed():
+    body = ('Funding has been awarded to nine pioneering projects to help Scottish remanufacturing businesses make '
+            'the most efficient use of material, the government said')
+    documents = [('Scotland awards funding to nine remanufacturing projects', body + ' on Monday.', 'https://bbc.com/a'),
+                 ('Scotland awards funding to 9 remanufacturing projects - Reuters', body + ' Monday.', 'https://reuters.com/x'),
+                 ('Cats love milk', 'Cats are nice animals and some of them like milk a lot.', 'https://cats.com/')]
+    assert NearDuplicates().representatives(documents) == [0, 0, 2]
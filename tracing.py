@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import threading
+from functools import wraps
+
+
+class Span:
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.emit(self.name, self.start, end, self.args)
+        return False
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Tracer:
+    """Nested timing spans written as Chrome trace events, viewable in Perfetto or chrome://tracing.
+
+    Spans are complete ("X") events on the thread that ran them, so spans opened inside other spans
+    nest in the viewer. Events are streamed to the file in the JSON array format, which the viewers
+    read even when the closing bracket is missing, so a crashed run still leaves a usable trace.
+    While disabled, `span` returns a shared no-op context manager and `traced` functions call straight through.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.file = None
+        self.lock = threading.Lock()
+        self.threads = set()
+
+    def start(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write('[\n')
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.enabled = True
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        with self.lock:
+            self.file.write(json.dumps({'name': 'trace_end', 'ph': 'i', 's': 'g', 'pid': self.pid, 'tid': 0,
+                                        'ts': (time.perf_counter() - self.origin) * 1e6}) + '\n]\n')
+            self.file.close()
+            self.file = None
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return null_span
+        return Span(self, name, args)
+
+    def traced(self, name=None):
+        # Decorator: run every call of the function in a span named after it
+        def decorator(fn):
+            span_name = name or fn.__name__
+
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with Span(self, span_name, {}):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def emit(self, name, start, end, args):
+        thread = threading.current_thread()
+        event = {'name': name, 'ph': 'X', 'pid': self.pid, 'tid': thread.ident,
+                 'ts': round((start - self.origin) * 1e6, 1), 'dur': round((end - start) * 1e6, 1)}
+        if args:
+            event['args'] = args
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self.lock:
+            if self.file is None:
+                return
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.file.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident,
+                                            'args': {'name': thread.name}}) + ',\n')
+            self.file.write(line + ',\n')
+
+
+# Shared by the whole process; started by lemma.py --trace
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
@@ -1,14 +1,19 @@
-
 import io
 import sys
 import json
 import base64
-import requests
-from openai import OpenAI
-from langdetect import detect
-from configs import out_root, prompts_root, cache_root, imgbed_root, OPENAI_KEY
+import threading
+from configs import out_root, prompts_root, cache_root, imgbed_root, backend_concurrency
+from llm_transport import get_transport, text_messages, image_messages
+from region_detection import region_detector
+
+# One semaphore per external backend, shared by all worker threads
+# (OpenAI calls are bounded inside llm_transport instead)
+backend_semaphores = {name: threading.BoundedSemaphore(limit) for name, limit in backend_concurrency.items() if name != "openai"}
+
 
-client = OpenAI()
+def backend_slot(name):
+    return backend_semaphores[name]
 
 
 def perror(str):
@@ -17,6 +22,22 @@ def perror(str):
 def pwarn(str):
     print("\033[33m"+str+"\033[0m")
     
+prompt_marker = "<!-- item -->"
+
+
+def load_prompt(name, **static_fields):
+    # prompts/<name> -> (system, template). The text above the marker line is the same for every item:
+    # it is formatted once with static_fields and sent as the system message, a stable prefix the API
+    # can serve from its prompt cache once it reaches 1024 tokens. The text below is the per-item
+    # template. No marker: system is None
+    with open(prompts_root + name, "r", encoding="utf-8") as f:
+        text = f.read()
+    if prompt_marker not in text:
+        return None, text
+    system, template = text.split(prompt_marker, 1)
+    return system.strip().format(**static_fields), template.lstrip("\n")
+
+
 def process_multilines_output(x):
     lines=x.split("\n")
     label=lines[-1].strip().lower()
@@ -25,81 +46,26 @@ def process_multilines_output(x):
 
 
 def onlineImg_process(prompt, url, model="gpt-4o", max_tokens=1000, temperature=0.1):
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"{url}",
-                        },
-                    },
-                ],
-            }
-        ],
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
-    return response.choices[0].message.content
+    return get_transport().chat(image_messages(prompt, url), model=model,
+                                max_tokens=max_tokens, temperature=temperature)
 
 
-def offlineImg_process(prompt, image_path, model="gpt-4-vision-preview", max_tokens=1000, temperature=0.1):
-    # Encode function
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+def encode_image(image_path):
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
 
+
+def offlineImg_process(prompt, image_path, model="gpt-4-vision-preview", max_tokens=1000, temperature=0.1):
     # Getting the base64 string
     base64_image = encode_image(image_path)
-
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_KEY}"
-    }
-
-    payload = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
-                        }
-                    }
-                ]
-            }
-        ],
-        "max_tokens": max_tokens,
-        "temperature": temperature
-    }
-
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-
-    return eval(response.text)["choices"][0]["message"]["content"]
+    return get_transport().chat(image_messages(prompt, f"data:image/jpeg;base64,{base64_image}"), model=model,
+                                max_tokens=max_tokens, temperature=temperature)
 
 
 def gpt_no_image(prompt, model="gpt-3.5-turbo", max_tokens=1000, temperature=0.1):
-    
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        max_tokens=max_tokens,
-        temperature=temperature
-    )
-    return response.choices[0].message.content
+    return get_transport().chat(text_messages(prompt), model=model,
+                                max_tokens=max_tokens, temperature=temperature)
+
 
 def image_caption(source, is_url=True):
 
@@ -179,107 +145,165 @@ def metric(labels, pred_labels):
     }
 
 
+def format_metric_result(data, prefix=''):
+    lines = []
+    if prefix:
+        lines.append('{}\n'.format(prefix))
+    lines.append('Labels:\n{}\nPredictions:\n{}\n\n'.format(data['labels'], data['predictions']))
+
+    lines.append('Accuracy: {}\n\n'.format(data['accuracy']))
+
+    lines.append('Rumor Section:\n')
+    lines.append('True positives: {}\n'.format(data['rumor']['true_positives']))
+    lines.append('False positives: {}\n'.format(data['rumor']['false_positives']))
+    lines.append('False negatives: {}\n'.format(data['rumor']['false_negatives']))
+    lines.append('True negatives: {}\n'.format(data['rumor']['true_negatives']))
+    lines.append('Precision: {}\n'.format(data['rumor']['precision']))
+    lines.append('Recall: {}\n'.format(data['rumor']['recall']))
+    lines.append('F1 Score: {}\n\n'.format(data['rumor']['f1']))
+
+    lines.append('Non-rumor Section:\n')
+    lines.append('True positives: {}\n'.format(data['non_rumor']['true_positives']))
+    lines.append('False positives: {}\n'.format(data['non_rumor']['false_positives']))
+    lines.append('False negatives: {}\n'.format(data['non_rumor']['false_negatives']))
+    lines.append('True negatives: {}\n'.format(data['non_rumor']['true_negatives']))
+    lines.append('Precision: {}\n'.format(data['non_rumor']['precision']))
+    lines.append('Recall: {}\n'.format(data['non_rumor']['recall']))
+    lines.append('F1 Score: {}\n\n'.format(data['non_rumor']['f1']))
+    return ''.join(lines)
+
+
 def write_metric_result(file_name, data, mode='w', prefix=''):
     with open(file_name, mode, encoding='utf-8') as f:
-        if prefix:
-            f.write('{}\n'.format(prefix))
-        f.write('Labels:\n{}\nPredictions:\n{}\n\n'.format(data['labels'], data['predictions']))
-
-        f.write('Accuracy: {}\n\n'.format(data['accuracy']))
-
-        f.write('Rumor Section:\n')
-        f.write('True positives: {}\n'.format(data['rumor']['true_positives']))
-        f.write('False positives: {}\n'.format(data['rumor']['false_positives']))
-        f.write('False negatives: {}\n'.format(data['rumor']['false_negatives']))
-        f.write('True negatives: {}\n'.format(data['rumor']['true_negatives']))
-        f.write('Precision: {}\n'.format(data['rumor']['precision']))
-        f.write('Recall: {}\n'.format(data['rumor']['recall']))
-        f.write('F1 Score: {}\n\n'.format(data['rumor']['f1']))
-
-        f.write('Non-rumor Section:\n')
-        f.write('True positives: {}\n'.format(data['non_rumor']['true_positives']))
-        f.write('False positives: {}\n'.format(data['non_rumor']['false_positives']))
-        f.write('False negatives: {}\n'.format(data['non_rumor']['false_negatives']))
-        f.write('True negatives: {}\n'.format(data['non_rumor']['true_negatives']))
-        f.write('Precision: {}\n'.format(data['non_rumor']['precision']))
-        f.write('Recall: {}\n'.format(data['non_rumor']['recall']))
-        f.write('F1 Score: {}\n\n'.format(data['non_rumor']['f1']))
+        f.write(format_metric_result(data, prefix))
+
+
+class MetricsAccumulator:
+    """Running version of metric() and stats() over (label, direct, prediction) triples.
+
+    `update` costs O(1): it only moves the confusion matrices of the refined and direct predictions
+    and the direct -> refined flip counters. The label lists of the lemma_score layout are ordered by
+    dataset index when rendered, so items may be added in any order.
+    """
+    count_names = ['items', 'total_correct', 'total_incorrect', 'zero_shot_correct', 'zero_shot_incorrect',
+                   'total_modified', 'total_modified_0_to_1', 'total_modified_0_to_1_correct',
+                   'total_modified_0_to_1_incorrect', 'total_modified_1_to_0', 'total_modified_1_to_0_correct',
+                   'total_modified_1_to_0_incorrect', 'total_unmodified', 'total_modified_correct',
+                   'total_modified_incorrect']
+
+    def __init__(self):
+        self.items = {}     # index -> (label, direct, prediction)
+        self.counts = dict.fromkeys(self.count_names, 0)
+        # Rumor (label 1) confusion matrices; the non-rumor ones are the same counts swapped
+        self.confusion = {'lemma': dict.fromkeys(['tp', 'fp', 'fn', 'tn'], 0),
+                          'direct': dict.fromkeys(['tp', 'fp', 'fn', 'tn'], 0)}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, index):
+        return index in self.items
+
+    def _apply(self, label, direct, prediction, sign):
+        c = self.counts
+        c['items'] += sign
+        c['total_correct' if prediction == label else 'total_incorrect'] += sign
+        c['zero_shot_correct' if direct == label else 'zero_shot_incorrect'] += sign
+        if prediction != direct:
+            flip = 'total_modified_0_to_1' if direct == 0 else 'total_modified_1_to_0'
+            outcome = '_correct' if prediction == label else '_incorrect'
+            c['total_modified'] += sign
+            c[flip] += sign
+            c[flip + outcome] += sign
+            c['total_modified' + outcome] += sign
+        else:
+            c['total_unmodified'] += sign
+        for name, pred in (('lemma', prediction), ('direct', direct)):
+            cell = ('t' if pred == label else 'f') + ('p' if pred == 1 else 'n')
+            self.confusion[name][cell] += sign
+
+    def update(self, label, direct, prediction, index=None):
+        if index is None:
+            index = len(self.items)
+        if index in self.items:
+            self._apply(*self.items[index], sign=-1)
+        self.items[index] = (label, direct, prediction)
+        self._apply(label, direct, prediction, sign=1)
+
+    def lists(self):
+        ordered = [self.items[index] for index in sorted(self.items)]
+        return [item[0] for item in ordered], [item[1] for item in ordered], [item[2] for item in ordered]
+
+    def metric(self, name='lemma'):
+        # Same structure as metric(labels, predictions), for the refined ('lemma') or 'direct' predictions
+        def scores(tp, fp, fn, tn):
+            precision = tp / (tp + fp) if tp + fp > 0 else 0
+            recall = tp / (tp + fn) if tp + fn > 0 else 0
+            f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0
+            return {'true_positives': tp, 'false_positives': fp, 'false_negatives': fn, 'true_negatives': tn,
+                    'precision': precision, 'recall': recall, 'f1': f1}
+
+        m = self.confusion[name]
+        labels, direct, predictions = self.lists()
+        return {
+            'labels': labels,
+            'predictions': predictions if name == 'lemma' else direct,
+            'accuracy': (m['tp'] + m['tn']) / len(self.items),
+            'rumor': scores(m['tp'], m['fp'], m['fn'], m['tn']),
+            'non_rumor': scores(m['tn'], m['fn'], m['fp'], m['tp']),
+        }
+
+    def stats_text(self):
+        c = self.counts
+        num_items = c['items']
+        lines = [
+            'Total items: {}'.format(num_items),
+            'Total correct: {}'.format(c['total_correct']),
+            'Total incorrect: {}'.format(c['total_incorrect']),
+            'Total Accuracy: {}'.format(c['total_correct'] / num_items),
+            'Zero-shot correct: {}'.format(c['zero_shot_correct']),
+            'Zero-shot incorrect: {}'.format(c['zero_shot_incorrect']),
+            'Zero-shot Accuracy: {}'.format(c['zero_shot_correct'] / num_items),
+            'Total modified: {}\n\t| 0 -> 1: {}\n\t\t| Correct: {}\n\t\t| Incorrect : {}\n\t| 1-> 0: {}\n\t\t| Correct: {}\n\t\t| Incorrect : {}'.format(
+                c['total_modified'], c['total_modified_0_to_1'], c['total_modified_0_to_1_correct'],
+                c['total_modified_0_to_1_incorrect'], c['total_modified_1_to_0'], c['total_modified_1_to_0_correct'],
+                c['total_modified_1_to_0_incorrect']),
+            'Total unmodified: {}'.format(c['total_unmodified']),
+            'Total modified correct: {}'.format(c['total_modified_correct']),
+            'Total modified incorrect: {}'.format(c['total_modified_incorrect']),
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def render_score(self, current_index):
+        # The lemma_score layout written by save()
+        labels, direct, predictions = self.lists()
+        return ('Labels:\n{}\nZero-shot:\n{}\nPredictions:\n{}\nCurrent Index:{}\n'.format(labels, direct, predictions, current_index)
+                + self.stats_text()
+                + format_metric_result(self.metric('lemma'), prefix='lemma section')
+                + format_metric_result(self.metric('direct'), prefix='zero shot section'))
+
+    def to_dict(self):
+        return {'items': [[index] + list(item) for index, item in self.items.items()],
+                'counts': self.counts, 'confusion': self.confusion}
+
+    @classmethod
+    def from_dict(cls, state):
+        accumulator = cls()
+        accumulator.items = {item[0]: tuple(item[1:]) for item in state['items']}
+        accumulator.counts.update(state['counts'])
+        for name in accumulator.confusion:
+            accumulator.confusion[name].update(state['confusion'][name])
+        return accumulator
 
 
 def stats(data_path):
     with open(data_path, 'r', encoding='utf-8') as f:
         data = json.load(f)
 
-    num_items = len(data)
-    labels = []
-    predictions = []
-    zero_shot_predictions = []
-    total_correct = 0
-    total_incorrect = 0
-    zero_shot_correct = 0
-    zero_shot_incorrect = 0
-    total_modified = 0
-    total_modified_0_to_1 = 0
-    total_modified_0_to_1_correct = 0
-    total_modified_0_to_1_incorrect = 0
-    total_modified_1_to_0 = 0
-    total_modified_1_to_0_correct = 0
-    total_modified_1_to_0_incorrect = 0
-    total_unmodified = 0
-    total_modified_correct = 0
-    total_modified_incorrect = 0
-
+    accumulator = MetricsAccumulator()
     for item in data:
-        labels.append(item['label'])
-        predictions.append(item['prediction'])
-        zero_shot_predictions.append(item['direct'])
-        if item['label'] == item['direct']:
-            if item['prediction'] != item['label']:
-                total_incorrect += 1
-                zero_shot_correct += 1
-                total_modified += 1
-                if item['direct'] == 0:
-                    total_modified_0_to_1 += 1
-                    total_modified_0_to_1_incorrect += 1
-                else:
-                    total_modified_1_to_0 += 1
-                    total_modified_1_to_0_incorrect += 1
-                total_modified_incorrect += 1
-            else:
-                total_correct += 1
-                zero_shot_correct += 1
-                total_unmodified += 1
-        else:
-            if item['prediction'] == item['label']:
-                total_correct += 1
-                zero_shot_incorrect += 1
-                total_modified += 1
-                if item['direct'] == 0:
-                    total_modified_0_to_1 += 1
-                    total_modified_0_to_1_correct += 1
-                else:
-                    total_modified_1_to_0 += 1
-                    total_modified_1_to_0_correct += 1
-                total_modified_correct += 1
-            else:
-                total_incorrect += 1
-                zero_shot_incorrect += 1
-                total_unmodified += 1
-
-    print('Total items: {}'.format(num_items))
-    print('Total correct: {}'.format(total_correct))
-    print('Total incorrect: {}'.format(total_incorrect))
-    print('Total Accuracy: {}'.format(total_correct / num_items))
-    print('Zero-shot correct: {}'.format(zero_shot_correct))
-    print('Zero-shot incorrect: {}'.format(zero_shot_incorrect))
-    print('Zero-shot Accuracy: {}'.format(zero_shot_correct / num_items))
-    print(
-        'Total modified: {}\n\t| 0 -> 1: {}\n\t\t| Correct: {}\n\t\t| Incorrect : {}\n\t| 1-> 0: {}\n\t\t| Correct: {}\n\t\t| Incorrect : {}'.format(
-            total_modified, total_modified_0_to_1, total_modified_0_to_1_correct, total_modified_0_to_1_incorrect,
-            total_modified_1_to_0, total_modified_1_to_0_correct, total_modified_1_to_0_incorrect))
-    print('Total unmodified: {}'.format(total_unmodified))
-    print('Total modified correct: {}'.format(total_modified_correct))
-    print('Total modified incorrect: {}'.format(total_modified_incorrect))
+        accumulator.update(item['label'], item['direct'], item['prediction'])
+    print(accumulator.stats_text(), end='')
 
 
 def stats_str(path):
@@ -292,35 +316,31 @@ def stats_str(path):
 
 
 def predict_region(s):
-    lang = detect(s)
-    region_map = {
-        'en': 'us-en',
-        # 'ca': 'ct-ca',
-        'zh-cn': 'tw-tzh',
-        'zh-tw': 'tw-tzh',
-        # 'fr': 'fr-fr',
-        # 'tr': 'tr-tr',
-        # 'nl': 'nl-nl',
-    }
-    if lang in region_map:
-        return region_map[lang]
-    else:
-        return 'us-en'
+    return region_detector.region(s)
 
 
 def save(labels, pred_labels, zero_shot_labels, current_index, all_results, output_result, output_score):
     with open(output_result, 'w', encoding='utf-8') as f:
         json.dump(all_results, f, ensure_ascii=False, indent=4)
+    accumulator = MetricsAccumulator()
+    for label, zero_shot, pred in zip(labels, zero_shot_labels, pred_labels):
+        accumulator.update(label, zero_shot, pred)
     with open(output_score, 'w', encoding='utf-8') as f:
-        f.write('Labels:\n{}\nZero-shot:\n{}\nPredictions:\n{}\nCurrent Index:{}\n'.format(labels, zero_shot_labels,
-                                                                                           pred_labels, current_index))
-        f.write(stats_str(output_result))
+        f.write(accumulator.render_score(current_index))
 
-    evaluation_result = metric(labels, pred_labels)
-    write_metric_result(output_score, evaluation_result, 'a', prefix='lemma section')
 
-    evaluation_result = metric(labels, zero_shot_labels)
-    write_metric_result(output_score, evaluation_result, 'a', prefix='zero shot section')
+def save_records(records, metrics, output_result, output_score):
+    # records: dataset index -> log record (None for skipped items); metrics: MetricsAccumulator over them
+    logger = [records[index] for index in sorted(records) if records[index] is not None]
+    # "Current Index" is the end of the finished prefix of the dataset
+    current_index = -1
+    while current_index + 1 in records:
+        current_index += 1
+    with open(output_result, 'w', encoding='utf-8') as f:
+        json.dump(logger, f, ensure_ascii=False, indent=4)
+    with open(output_score, 'w', encoding='utf-8') as f:
+        f.write(metrics.render_score(current_index))
+    return current_index
 
 
 def save_baseline(labels, pred_labels, current_index, all_results, output_result, output_score):